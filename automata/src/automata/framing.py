@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Binary frames for serial links, COBS encoded with CRC
+"""
+
+import binascii
+from typing import Tuple
+
+# Frame types
+CMD = 0x01  # Command of a session, service to device
+LINE = 0x02  # Line of response, device to service (session 0: unsolicited)
+END = 0x03  # End of response of a session, device to service
+ERROR = 0x04  # Session failed on device (e.g. corrupted command frame)
+
+# Frames are delimited by zero byte, which COBS removes from the content
+DELIMITER = b'\x00'
+# Session ids are 2 bytes, 0 is reserved for lines outside of sessions
+MAX_SESSION_ID = 0xFFFF
+
+
+class FrameError(ValueError):
+    """
+    Frame cannot be decoded or its CRC does not match
+    """
+
+
+def crc16(data: bytes) -> int:
+    """
+    CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF)
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def cobs_encode(data: bytes) -> bytes:
+    """
+    Consistent overhead byte stuffing, result has no zero byte
+    """
+    encoded = bytearray()
+    for block in data.split(DELIMITER):
+        while len(block) >= 254:
+            encoded.append(0xFF)
+            encoded += block[:254]
+            block = block[254:]
+        encoded.append(len(block) + 1)
+        encoded += block
+    return bytes(encoded)
+
+
+def cobs_decode(data: bytes) -> bytes:
+    decoded = bytearray()
+    index = 0
+    length = len(data)
+    while index < length:
+        code = data[index]
+        if code == 0 or index + code > length:
+            raise FrameError('invalid COBS encoding')
+        decoded += data[index + 1:index + code]
+        index += code
+        if code < 0xFF and index < length:
+            decoded.append(0)
+    return bytes(decoded)
+
+
+def encode_frame(frame_type: int, session_id: int, data=b'') -> bytes:
+    """
+    Frame ready to be written to serial: COBS encoded type, session id, data
+    and CRC of them, followed by delimiter
+    """
+    content = bytes((frame_type, )) + session_id.to_bytes(2, 'big') + data
+    content += crc16(content).to_bytes(2, 'big')
+    return cobs_encode(content) + DELIMITER
+
+
+def decode_frame(frame: bytes) -> Tuple[int, int, bytes]:
+    """
+    Type, session id and data of frame received without delimiter
+    """
+    content = cobs_decode(frame)
+    if len(content) < 5:
+        raise FrameError('frame too short')
+    if crc16(content[:-2]) != int.from_bytes(content[-2:], 'big'):
+        raise FrameError('CRC mismatch')
+    return content[0], int.from_bytes(content[1:3], 'big'), content[3:-2]
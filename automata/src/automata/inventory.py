@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Inventory of serial ports available on robot
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import threading
+from typing import Callable, Dict, List, Optional, Type
+
+from serial.tools import list_ports
+
+# Directories where serial ports appear and disappear
+WATCHED_PATHS = ('/dev', '/sys/class/tty')
+# inotify events of entries created, deleted or renamed
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+
+
+class PortInventory:
+    """
+    Serial ports available on robot, enumerated once and kept in memory.
+    Ports are enumerated again when entries of `/dev` or `/sys/class/tty`
+    change (watched with inotify on Linux), or every `interval` seconds where
+    inotify is not available. Changes are passed to `on_change` as a dict
+    with `added` (ports added or changed) and `removed` (device names).
+    """
+    def __init__(self,
+                 logger: Type[logging.Logger],
+                 interval=5.0,
+                 settle=0.5):
+        self.logger = logger
+        self.interval = interval
+        # Seconds to wait for burst of changes to end before enumerating
+        self.settle = settle
+        self.on_change: Optional[Callable[[Dict], None]] = None
+        self.ports: Dict[str, Dict] = {}
+        self.scanned = False
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def _enumerate() -> Dict[str, Dict]:
+        return {
+            port.device: dict(port.__dict__)
+            for port in list_ports.comports(include_links=True)
+        }
+
+    def refresh(self) -> Optional[Dict]:
+        """
+        Enumerate ports again, return changes if any
+        """
+        ports = self._enumerate()
+        with self.lock:
+            added = [
+                port for device, port in ports.items()
+                if self.ports.get(device) != port
+            ]
+            removed = [device for device in self.ports if device not in ports]
+            self.ports = ports
+            self.scanned = True
+        if len(added) == 0 and len(removed) == 0:
+            return None
+        changes = {'added': added, 'removed': removed}
+        self.logger.info(f'Comports changed: {len(added)} added, '
+                         f'{len(removed)} removed')
+        if self.on_change is not None:
+            self.on_change(changes)
+        return changes
+
+    def list(self) -> List[Dict]:
+        """
+        Available ports, enumerated on first call if not watching yet
+        """
+        if not self.scanned:
+            self.refresh()
+        return list(self.ports.values())
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _inotify(self) -> Optional[int]:
+        """
+        File descriptor of inotify instance watching port directories, None
+        if inotify is not available
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        watched = 0
+        for path in WATCHED_PATHS:
+            if libc.inotify_add_watch(fd, path.encode(), mask) >= 0:
+                watched += 1
+        if watched == 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _drain(self, fd: int):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        self._safe_refresh()
+        fd = self._inotify()
+        if fd is None:
+            self.logger.info('inotify not available, polling comports every '
+                             f'{self.interval}s')
+            while not self.stopping.wait(self.interval):
+                self._safe_refresh()
+            return
+        try:
+            while not self.stopping.is_set():
+                # Wake up regularly to notice stop
+                readable, _, _ = select.select([fd], [], [], 1)
+                if not readable:
+                    continue
+                # Wait for the burst of changes of a plugged device to end
+                self.stopping.wait(self.settle)
+                self._drain(fd)
+                self._safe_refresh()
+        finally:
+            os.close(fd)
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self.logger.error(f'Cannot list comports: {e}')
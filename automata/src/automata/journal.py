@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Journal of serial traffic, kept in a fixed-size memory-mapped ring file per
+comport, and replay of recorded traffic through a protocol
+"""
+
+import argparse
+import datetime
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from typing import Iterable, Iterator, List, Tuple
+
+# Magic, version, size of the ring, absolute positions of head and tail
+HEADER = struct.Struct('<4sIQQQ')
+MAGIC = b'AJNL'
+VERSION = 1
+# Unix timestamp, direction and length of the data following the record
+RECORD = struct.Struct('<dBI')
+# Directions of records
+RECEIVED = 0
+SENT = 1
+# Skipped end of the ring, the next record starts at the beginning
+PADDING = 2
+
+Record = Tuple[float, int, bytes]
+
+
+class Journal:
+    """
+    Ring of records of the data received from and sent to a comport, in a
+    file mapped in memory. Appending only copies the data to the mapping, the
+    kernel writes it back to the file, so records survive the service but
+    not a power loss. When the ring is full, oldest records are dropped.
+    Positions of head and tail grow forever, their offset in the ring is the
+    position modulo `size`. A record never wraps around the end of the ring,
+    the end is skipped instead.
+    """
+    def __init__(self, path: str, size=1 << 20, create=True):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+        try:
+            fresh = not self._valid(fd)
+            if fresh and not create:
+                raise ValueError(f'{path} is not a journal')
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, HEADER.size + size)
+            self.mm = mmap.mmap(fd, HEADER.size + size)
+        finally:
+            os.close(fd)
+        if fresh:
+            self.head = self.tail = 0
+            self._store_positions()
+        else:
+            _, _, _, self.head, self.tail = HEADER.unpack_from(self.mm)
+
+    def _valid(self, fd: int) -> bool:
+        """
+        Whether file already holds a journal of the same size, to continue
+        """
+        header = os.pread(fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            return False
+        magic, version, size, head, tail = HEADER.unpack(header)
+        return (magic == MAGIC and version == VERSION and size == self.size
+                and 0 <= head - tail <= size
+                and os.fstat(fd).st_size == HEADER.size + size)
+
+    def _store_positions(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.size, self.head,
+                         self.tail)
+
+    def _next(self, position: int) -> int:
+        """
+        Position of the record following the one at `position`
+        """
+        offset = position % self.size
+        if self.size - offset < RECORD.size:
+            return position + self.size - offset
+        _, direction, length = RECORD.unpack_from(self.mm,
+                                                  HEADER.size + offset)
+        if direction == PADDING:
+            return position + self.size - offset
+        return position + RECORD.size + length
+
+    def append(self, direction: int, data: bytes):
+        """
+        Record data with current time, data larger than the ring is truncated
+        """
+        data = data[:self.size - RECORD.size]
+        length = RECORD.size + len(data)
+        timestamp = time.time()
+        with self.lock:
+            if self.mm is None:
+                return
+            head = self.head
+            offset = head % self.size
+            skipped = self.size - offset if self.size - offset < length else 0
+            end = head + skipped + length
+            # Drop records about to be overwritten
+            while end - self.tail > self.size:
+                if self.tail >= head:
+                    # Record fills the whole ring
+                    self.tail = head + skipped
+                    break
+                self.tail = self._next(self.tail)
+            if skipped >= RECORD.size:
+                RECORD.pack_into(self.mm, HEADER.size + offset, timestamp,
+                                 PADDING, 0)
+            offset = (head + skipped) % self.size
+            RECORD.pack_into(self.mm, HEADER.size + offset, timestamp,
+                             direction, len(data))
+            start = HEADER.size + offset + RECORD.size
+            self.mm[start:start + len(data)] = data
+            self.head = end
+            self._store_positions()
+
+    def records(self) -> List[Record]:
+        """
+        Records of the ring, oldest first
+        """
+        records = []
+        with self.lock:
+            if self.mm is None:
+                return records
+            position = self.tail
+            while position < self.head:
+                offset = position % self.size
+                if self.size - offset >= RECORD.size:
+                    timestamp, direction, length = RECORD.unpack_from(
+                        self.mm, HEADER.size + offset)
+                    if direction != PADDING:
+                        start = HEADER.size + offset + RECORD.size
+                        records.append((timestamp, direction,
+                                        bytes(self.mm[start:start + length])))
+                position = self._next(position)
+        return records
+
+    def close(self):
+        with self.lock:
+            if self.mm is not None:
+                self.mm.close()
+                self.mm = None
+
+
+def journal_path(directory: str, comport: str) -> str:
+    """
+    Path of the journal of comport in directory, e.g. `_dev_ttyUSB0.journal`
+    """
+    return os.path.join(directory,
+                        re.sub(r'[^\w.-]', '_', comport) + '.journal')
+
+
+def replay(records: Iterable[Record], protocol, speed=1.0) -> int:
+    """
+    Feed data received in records to `protocol.data_received`, keeping the
+    recorded time between records divided by `speed`, or as fast as possible
+    if `speed` is 0. Return the number of bytes fed.
+    """
+    fed = 0
+    start = time.monotonic()
+    first = None
+    for timestamp, direction, data in records:
+        if direction != RECEIVED:
+            continue
+        if speed > 0:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        protocol.data_received(data)
+        fed += len(data)
+    return fed
+
+
+def dump(records: Iterable[Record]) -> Iterator[str]:
+    for timestamp, direction, data in records:
+        moment = datetime.datetime.fromtimestamp(timestamp).isoformat(
+            timespec='microseconds')
+        yield f'{moment} {"<" if direction == RECEIVED else ">"} {data!r}'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Show or replay a journal of serial traffic')
+    parser.add_argument('command', choices=('dump', 'replay'))
+    parser.add_argument('path', help='journal file')
+    parser.add_argument('--speed',
+                        type=float,
+                        default=1.0,
+                        help='replay speed factor, 0 for as fast as possible')
+    parser.add_argument('--framing', choices=('text', 'cobs'), default='text')
+    parser.add_argument('--cmd-mark', default='!')
+    parser.add_argument('--encoding', default='ascii')
+    parser.add_argument('--terminator', default='\n')
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.path) - HEADER.size
+    journal = Journal(args.path, size, create=False)
+    records = journal.records()
+    journal.close()
+    if args.command == 'dump':
+        for line in dump(records):
+            print(line)
+        return
+
+    from .service import AutomataProtocol, BinaryAutomataProtocol
+    logger = logging.getLogger(__name__)
+    protocol_class = (BinaryAutomataProtocol
+                      if args.framing == 'cobs' else AutomataProtocol)
+    protocol = protocol_class(logger=logger,
+                              cmd_mark=args.cmd_mark,
+                              encoding=args.encoding,
+                              terminator=args.terminator)
+    if args.framing == 'cobs':
+        # Negotiation is usually overwritten in the ring, frames are decoded
+        # from the start
+        protocol.framing = 'cobs'
+    # Lines outside of sessions are only counted
+    protocol.on_unsolicited = lambda line: None
+    start = time.monotonic()
+    fed = replay(records, protocol, args.speed)
+    elapsed = max(time.monotonic() - start, 1e-9)
+    metrics = protocol.metrics.snapshot()
+    print(f'Replayed {fed} bytes, {metrics["lines_received"]} lines in '
+          f'{elapsed:.3f}s ({metrics["lines_received"] / elapsed:,.0f} '
+          f'lines/s), faulty: {metrics["faulty"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of serial ports, sent periodically to management hub
+"""
+
+import bisect
+import collections
+import logging
+import threading
+from typing import Callable, Dict, Type
+
+import socketio
+
+# Upper bounds in seconds of the buckets of send_cmd latency
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+class Histogram:
+    """
+    Number of observed values in each bucket (values not greater than its
+    upper bound and greater than the previous one), the last bucket counts
+    values above all bounds
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {
+                'buckets': list(self.buckets),
+                'counts': list(self.counts),
+                'sum': self.sum,
+            }
+
+
+class ComportMetrics:
+    """
+    Counters of the traffic of a serial port. Received data is only counted
+    by the reader thread, so counters are updated without lock.
+    """
+    def __init__(self):
+        self.bytes_received = 0
+        self.lines_received = 0
+        # Faulty responses or frames by kind
+        self.faulty = collections.Counter()
+        self.send_cmd = Histogram()
+
+    def snapshot(self) -> Dict:
+        return {
+            'bytes_received': self.bytes_received,
+            'lines_received': self.lines_received,
+            'faulty': dict(self.faulty),
+            'send_cmd': self.send_cmd.snapshot(),
+        }
+
+
+class MetricsUplink:
+    """
+    Send metrics collected from comports to management hub every `interval`
+    seconds, with the `metrics` event
+    """
+    def __init__(self,
+                 sio: socketio.Client,
+                 serial_number: str,
+                 collect: Callable[[], Dict[str, Dict]],
+                 logger: Type[logging.Logger],
+                 interval=10.0):
+        self.sio = sio
+        self.serial_number = serial_number
+        self.collect = collect
+        self.logger = logger
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            if not self.sio.connected:
+                continue
+            try:
+                self.sio.emit('metrics', {
+                    'serial_number': self.serial_number,
+                    'comports': self.collect(),
+                })
+            except Exception as e:
+                self.logger.error(f'Cannot send metrics: {e}')
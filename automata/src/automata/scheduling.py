@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Priority classes of commands and scheduling of session slots by priority
+"""
+
+import heapq
+import itertools
+import threading
+from typing import List, Optional, Tuple
+
+# Priority classes, lower value is served first
+EMERGENCY = 0
+CONTROL = 1
+BULK = 2
+PRIORITIES = {
+    'emergency': EMERGENCY,
+    'control': CONTROL,
+    'bulk': BULK,
+}
+DEFAULT_PRIORITY = 'control'
+
+
+def priority_of(name: Optional[str]) -> int:
+    """
+    Priority of class name, default class if None, ValueError if unknown
+    """
+    try:
+        return PRIORITIES[name or DEFAULT_PRIORITY]
+    except KeyError:
+        raise ValueError(f'Unknown priority {name}')
+
+
+class PrioritySlots:
+    """
+    Slots of sessions allowed to wait for response at the same time on a
+    comport. A freed slot is given to the waiting command of highest
+    priority, then to the earliest one. Emergency commands do not wait for a
+    slot, they only wait for the write in progress.
+    """
+    def __init__(self, slots: int):
+        self.free = slots
+        # Waiting commands, as (priority, arrival)
+        self.waiting: List[Tuple[int, int]] = []
+        self.arrivals = itertools.count()
+        self.condition = threading.Condition()
+
+    def acquire(self, priority: int, timeout: float) -> bool:
+        """
+        Wait for a slot for command of priority, return False on timeout
+        """
+        if priority == EMERGENCY:
+            return True
+        with self.condition:
+            entry = (priority, next(self.arrivals))
+            heapq.heappush(self.waiting, entry)
+            acquired = self.condition.wait_for(
+                lambda: self.free > 0 and self.waiting[0] == entry, timeout)
+            if acquired:
+                self.free -= 1
+                heapq.heappop(self.waiting)
+            else:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+            # Next waiting command may take another free slot
+            self.condition.notify_all()
+            return acquired
+
+    def release(self, priority: int):
+        if priority == EMERGENCY:
+            return
+        with self.condition:
+            self.free += 1
+            self.condition.notify_all()
@@ -4,25 +4,65 @@
 Control service using socketio
 """
 
+import codecs
+import collections
+import functools
 import logging
 import os
-import queue
 import sys
 import threading
-from typing import Dict, List, Type
+import time
+from typing import Callable, Dict, List, Optional, Type
 
 import serial
 import socketio
 from serial.threaded import Protocol, ReaderThread
-from serial.tools import list_ports
+
+from . import framing
+from .inventory import PortInventory
+from .journal import RECEIVED, SENT, Journal, journal_path
+from .metrics import ComportMetrics, MetricsUplink
+from .scheduling import CONTROL, EMERGENCY, PrioritySlots, priority_of
+from .telemetry import TelemetryUplink
+from .tracing import Trace, start_trace
+from .workers import ComportWorkers
 
 # Address to api server, should use static IP on production server
 HUB_ADDR = os.getenv('HUB_ADDR') or 'http://localhost'
 HUB_PORT = int(os.getenv('HUB_PORT') or '5000')
 # Provide serial number as unique id for robot
 SERIAL_NUMBER = os.getenv('SERIAL_NUMBER') or 'dummy'
+# Batching of lines received outside of sessions, sent to hub as telemetry
+TELEMETRY_INTERVAL = float(os.getenv('TELEMETRY_INTERVAL') or '1')
+TELEMETRY_BATCH_SIZE = int(os.getenv('TELEMETRY_BATCH_SIZE') or '100')
+TELEMETRY_MAX_PENDING = int(os.getenv('TELEMETRY_MAX_PENDING') or '1000')
+# Serializer of socket.io packets, 'default' (json) or 'msgpack', must be
+# the same as management hub
+SOCKETIO_SERIALIZER = os.getenv('SOCKETIO_SERIALIZER') or 'default'
+# Interval of listing comports again where inotify is not available
+COMPORTS_POLL_INTERVAL = float(os.getenv('COMPORTS_POLL_INTERVAL') or '5')
+# Commands allowed to wait for execution on each comport
+COMPORT_QUEUE_SIZE = int(os.getenv('COMPORT_QUEUE_SIZE') or '100')
+# Lines and events received outside of sessions and not read are kept up to
+# this number for each comport, oldest are dropped
+UNREAD_SIZE = int(os.getenv('UNREAD_SIZE') or '1000')
+# Highest max_inflight of comports, each session slot has a worker thread
+MAX_INFLIGHT = int(os.getenv('MAX_INFLIGHT') or '8')
+# Protocol options accepted for each framing
+TEXT_OPTIONS = {
+    'cmd_mark', 'encoding', 'encode_method', 'terminator', 'max_inflight'
+}
+COBS_OPTIONS = TEXT_OPTIONS | {'negotiate_timeout'}
+# Interval of sending metrics of comports to hub, 0 to disable
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL') or '0')
+# Logging level, DEBUG logs every serial chunk and socket message
+LOG_LEVEL = (os.getenv('LOG_LEVEL') or 'INFO').upper()
+# Directory of journals of serial traffic of each comport, unset to disable,
+# and size in bytes of each journal
+JOURNAL_DIR = os.getenv('JOURNAL_DIR')
+JOURNAL_SIZE = int(os.getenv('JOURNAL_SIZE') or str(1 << 20))
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL)
 
 
 class AutomataProtocol(Protocol):
@@ -34,19 +74,87 @@ class AutomataProtocol(Protocol):
                  cmd_mark='!',
                  encoding='ascii',
                  encode_method='replace',
-                 terminator='\n'):
+                 terminator='\n',
+                 max_inflight=1,
+                 journal: Optional[Journal] = None):
         super(AutomataProtocol, self).__init__()
         self.logger = logger
         self.cmd_mark = cmd_mark  # For event processing
         self.encoding = encoding
         self.encode_method = encode_method
         self.terminator = terminator
-        self.responses = queue.Queue()
-        self.events = queue.Queue()
-        self.pending_line = ''
+        # Number of sessions allowed to wait for response at the same time
+        self.max_inflight = max_inflight
+        self.framing = 'text'
+        # Last lines and events that do not belong to any waiting session
+        self.responses = collections.deque(maxlen=UNREAD_SIZE)
+        self.events = collections.deque(maxlen=UNREAD_SIZE)
+        # Receiver of lines outside of sessions, replacing `responses` if set
+        self.on_unsolicited = None
+        # Received bytes not yet terminated, scanned up to `scan_pos`
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        # Set when options read by the reader thread changed
+        self.marks_changed = False
+        self._compile_marks()
+        # Session currently opened by the device
         self.session = None
+        # Buffers of sessions waiting for response, keyed by session id
+        self.sessions = {}
         self.lock = threading.Lock()
+        self.slots = PrioritySlots(max_inflight)
         self.transport = None
+        self.metrics = ComportMetrics()
+        # Recorder of data received and sent, if enabled
+        self.journal = journal
+
+    def _compile_marks(self):
+        """
+        Encode terminator and session marks to match on raw bytes, these
+        copies of the options are only used by the reader thread
+        """
+        self._decoding = self.encoding
+        self._begin_prefix = f'{self.cmd_mark}BEGIN '
+        self._end_prefix = f'{self.cmd_mark}END '
+        self._terminator = self.terminator.encode(self.encoding)
+        self._begin_mark = f'{self.cmd_mark}BEGIN'.encode(self.encoding)
+        self._end_mark = f'{self.cmd_mark}END'.encode(self.encoding)
+        self._cmd_mark = self.cmd_mark.encode(self.encoding)
+
+    def _apply_marks(self):
+        """
+        Take options changed by `reconfigure` in the reader thread, so they
+        do not change during a scan
+        """
+        if self.marks_changed:
+            with self.lock:
+                self._compile_marks()
+                self.marks_changed = False
+            # Received data is scanned again for the new terminator
+            self.scan_pos = 0
+
+    def reconfigure(self,
+                    cmd_mark='!',
+                    encoding='ascii',
+                    encode_method='replace',
+                    terminator='\n',
+                    max_inflight=1):
+        """
+        Change options in place, keeping received data and waiting sessions.
+        Options not specified are back to their defaults, as when creating
+        the protocol.
+        """
+        with self.lock:
+            self.cmd_mark = cmd_mark
+            self.encoding = encoding
+            self.encode_method = encode_method
+            self.terminator = terminator
+            # Applied by the reader thread, between two scans
+            self.marks_changed = True
+            if max_inflight != self.max_inflight:
+                # Sessions already waiting release the slots they acquired
+                self.max_inflight = max_inflight
+                self.slots = PrioritySlots(max_inflight)
 
     def connection_made(self, transport):
         """
@@ -61,6 +169,29 @@ class AutomataProtocol(Protocol):
         self.transport = None
         super(AutomataProtocol, self).connection_lost(exc)
 
+    def _write(self, data: bytes):
+        if self.journal is not None:
+            self.journal.append(SENT, data)
+        self.transport.write(data)
+
+    def _put_line(self, line: str):
+        buffer = self.sessions.get(self.session)
+        if buffer is not None:
+            buffer['responses'].append(line)
+            if buffer['on_line'] is not None:
+                buffer['on_line'](line)
+        elif self.on_unsolicited is not None:
+            self.on_unsolicited(line)
+        else:
+            self.responses.append(line)
+
+    def _put_event(self, event: Dict):
+        buffer = self.sessions.get(self.session)
+        if buffer is not None:
+            buffer['events'].append(event)
+        else:
+            self.events.append(event)
+
     def _batch_begin(self, line: str):
         event = None
         if self.session is not None:
@@ -70,19 +201,20 @@ class AutomataProtocol(Protocol):
                 'trace': line,
             }
             self.logger.fatal(event)
+            self.metrics.faulty['nested_begin'] += 1
+            self._put_event(event)
             self.session = None
         else:
-            self.session = line[len(f'{self.cmd_mark}BEGIN '):]
+            self.session = line[len(self._begin_prefix):]
             event = {
                 'event': 'begin',
                 'session': self.session,
             }
             self.logger.debug(event)
-        # Store event
-        self.events.put(event)
+            self._put_event(event)
 
     def _batch_end(self, line: str):
-        session = line[len(f'{self.cmd_mark}END '):]
+        session = line[len(self._end_prefix):]
         event = None
         if self.session is None:
             # Faulty device, yield error event
@@ -91,111 +223,356 @@ class AutomataProtocol(Protocol):
                 'trace': line,
             }
             self.logger.fatal(event)
+            self.metrics.faulty['end_without_begin'] += 1
         elif self.session != session:
-            self.session = None
             event = {
                 'error': 'Faulty response (unknown id)',
                 'trace': line,
             }
             self.logger.debug(event)
+            self.metrics.faulty['unknown_id'] += 1
         else:
             event = {
                 'event': 'end',
                 'session': self.session,
             }
-            self.session = None
         # Store event
-        self.events.put(event)
+        self._put_event(event)
+        buffer = self.sessions.get(self.session)
+        if buffer is not None and event.get('event') == 'end':
+            # Wake up the caller waiting for this session only
+            buffer['done'].set()
+        self.session = None
 
-    def _process_line(self, line: str):
-        self.responses.put(line)
-        # Simple integrity verification
-        if line.startswith(f'{self.cmd_mark}BEGIN'):
+    def _process_mark(self, line: str, buffer: bytearray, start: int):
+        # Simple integrity verification, done on raw bytes
+        if buffer.startswith(self._begin_mark, start):
             self._batch_begin(line)
-        elif line.startswith(f'{self.cmd_mark}END'):
+            self._put_line(line)
+        elif buffer.startswith(self._end_mark, start):
+            self._put_line(line)
             self._batch_end(line)
-        elif line.startswith(self.cmd_mark):
-            self.events.put({
+        else:
+            self._put_line(line)
+            self._put_event({
                 'error': 'Faulty response (unknown mark)',
                 'trace': line,
             })
+            self.metrics.faulty['unknown_mark'] += 1
 
     def data_received(self, data):
         """
         Protocol interface
         """
-        # Join with pending line and split by terminator
-        raw = data.decode(self.encoding)
-        self.logger.debug(f'Serial received raw data: {raw}')
-        buf = self.pending_line + raw
-        lines = buf.split(self.terminator)
-        self.logger.debug(f'Processed lines: {lines}')
-        self.pending_line = lines[-1] if len(lines) > 0 else ''
-        for line in lines[:-1]:
-            self._process_line(line)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Serial received raw data: %r', data)
+        self.metrics.bytes_received += len(data)
+        if self.journal is not None:
+            self.journal.append(RECEIVED, data)
+        self._apply_marks()
+        buffer = self.buffer
+        buffer += data
+        terminator = self._terminator
+        # Only scan the bytes that were not scanned in previous calls
+        pos = buffer.find(terminator, self.scan_pos)
+        if pos < 0:
+            self.scan_pos = max(len(buffer) - len(terminator) + 1, 0)
+            return
+        encoding = self._decoding
+        cmd_mark = self._cmd_mark
+        start = 0
+        lines = 0
+        with memoryview(buffer) as view:
+            while pos >= 0:
+                # Only complete lines are decoded
+                line = str(view[start:pos], encoding, 'replace')
+                if buffer.startswith(cmd_mark, start):
+                    self._process_mark(line, buffer, start)
+                else:
+                    self._put_line(line)
+                start = pos + len(terminator)
+                pos = buffer.find(terminator, start)
+                lines += 1
+        del buffer[:start]
+        self.scan_pos = max(len(buffer) - len(terminator) + 1, 0)
+        self.metrics.lines_received += lines
+
+    def send_cmd(self,
+                 session: str,
+                 cmd: str,
+                 timeout: int,
+                 on_line: Callable[[str], None] = None,
+                 trace: Optional[Trace] = None,
+                 priority=CONTROL) -> Dict:
+        """
+        Send command and wait for batch responses of its session.
+        Up to `max_inflight` sessions can wait for response at the same time,
+        each caller only wakes up when the end mark of its own session
+        arrives. Free slots go to waiting commands of highest `priority`
+        first, emergency commands are sent without waiting for a slot. If
+        `on_line` is given, it is called from the reader thread with each
+        line of the session as soon as the line is received. If `trace` is
+        given, the stages of sending are marked in it.
+        """
+        start = time.monotonic()
+        # Slots may be replaced by reconfiguration while waiting
+        slots = self.slots
+        if not slots.acquire(priority, timeout):
+            self.metrics.send_cmd.observe(time.monotonic() - start)
+            return {
+                'result': '',
+                'events': [{
+                    'error': f'Timeout waiting for free slot after {timeout}s',
+                }],
+            }
+        if trace is not None:
+            trace.mark('slot')
+        try:
+            with self.lock:
+                if trace is not None:
+                    trace.mark('locked')
+                if session in self.sessions:
+                    return {
+                        'result': '',
+                        'events': [{
+                            'error': f'Session {session} is already waiting',
+                        }],
+                    }
+                buffer = self.sessions[session] = {
+                    'responses': [],
+                    'events': [],
+                    'done': threading.Event(),
+                    'on_line': on_line,
+                }
+                self._write(self._encapsulate(session, cmd, buffer))
+                if trace is not None:
+                    trace.mark('written')
+            # Waiting for end event
+            if not buffer['done'].wait(timeout=timeout):
+                buffer['events'].append({
+                    'error': f'Timeout with no end mark after {timeout}s',
+                })
+            if trace is not None:
+                trace.mark('ended')
+            with self.lock:
+                self._close_session(session, buffer)
+            return {
+                'result': self.terminator.join(buffer['responses']),
+                'events': buffer['events'],
+            }
+        finally:
+            slots.release(priority)
+            self.metrics.send_cmd.observe(time.monotonic() - start)
 
-    def send_cmd(self, session: str, cmd: str, timeout: int) -> Dict:
+    def _encapsulate(self, session: str, cmd: str, buffer: Dict) -> bytes:
         """
-        Send command and wait for batch responses from events
+        Bytes to write to serial for command of session, called with lock
+        held
         """
         encapsulated = (f'{self.cmd_mark}BEGIN {session}{self.terminator}'
                         f'{cmd}{self.terminator}'
                         f'{self.cmd_mark}END {session}{self.terminator}')
         self.logger.debug(encapsulated)
+        return encapsulated.encode(self.encoding, self.encode_method)
+
+    def _close_session(self, session: str, buffer: Dict):
+        """
+        Forget session after its response, called with lock held
+        """
+        del self.sessions[session]
+
+
+class BinaryAutomataProtocol(AutomataProtocol):
+    """
+    Protocol exchanging COBS frames with serial device, each frame carrying a
+    numeric session id and a CRC, instead of text lines wrapped by session
+    marks. See `framing` module for the frame layout.
+    Binary framing is negotiated on connection by sending the text line
+    `<cmd_mark>FRAMING cobs`, device supporting it answers with the line
+    `<cmd_mark>FRAMING cobs OK` and switches to frames. Without answer,
+    protocol falls back to text framing, an echo of the request is not an
+    answer.
+    """
+    def __init__(self,
+                 logger: Type[logging.Logger],
+                 negotiate_timeout=1,
+                 **options):
+        super(BinaryAutomataProtocol, self).__init__(logger, **options)
+        self.negotiate_timeout = negotiate_timeout
+        # Framing is unknown until negotiation is done
+        self.framing = None
+        self.negotiated = threading.Event()
+        self._framing_line = f'{self.cmd_mark}FRAMING cobs'
+        self._framing_ack = f'{self._framing_line} OK'
+        # Session names of the numeric ids of waiting sessions
+        self.session_ids: Dict[int, str] = {}
+        self.next_session_id = 1
+
+    def reconfigure(self, negotiate_timeout=1, **options):
+        self.negotiate_timeout = negotiate_timeout
+        super(BinaryAutomataProtocol, self).reconfigure(**options)
+        self._framing_line = f'{self.cmd_mark}FRAMING cobs'
+        self._framing_ack = f'{self._framing_line} OK'
+
+    def negotiate(self) -> str:
+        """
+        Ask device to switch to binary framing, return framing in use
+        """
+        self._write(
+            f'{self._framing_line}{self.terminator}'.encode(self.encoding))
+        if not self.negotiated.wait(timeout=self.negotiate_timeout):
+            with self.lock:
+                if self.framing is None:
+                    self.logger.warning('Binary framing not supported by '
+                                        'device, using text framing')
+                    self.framing = 'text'
+                    self.marks_changed = True
+        return self.framing
+
+    def data_received(self, data):
+        """
+        Protocol interface
+        """
+        if self.framing == 'text':
+            return super(BinaryAutomataProtocol, self).data_received(data)
+        self.metrics.bytes_received += len(data)
+        if self.journal is not None:
+            self.journal.append(RECEIVED, data)
+        self._apply_marks()
+        buffer = self.buffer
+        buffer += data
+        if self.framing is None:
+            self._negotiation_received()
+            if self.framing is None:
+                return
+        start = 0
+        pos = buffer.find(framing.DELIMITER)
+        while pos >= 0:
+            if pos > start:
+                self._frame_received(bytes(buffer[start:pos]))
+            start = pos + 1
+            pos = buffer.find(framing.DELIMITER, start)
+        del buffer[:start]
+
+    def _negotiation_received(self):
+        """
+        Look for the answer of device among lines received while negotiating
+        """
+        buffer = self.buffer
+        terminator = self._terminator
         with self.lock:
-            # Clear pending line to prevent conflict
-            self.pending_line = ''
-            self.transport.write(
-                encapsulated.encode(self.encoding, self.encode_method))
-            responses = []
-            events = []
-            while True:
-                # Waiting for end event
-                try:
-                    event = self.events.get(timeout=timeout)
-                    events.append(event)
-                    if event.get('event') and event['event'] == 'end':
-                        break
-                except queue.Empty:
-                    events.append({
-                        'error':
-                        f'Timeout with no end mark after {timeout}s',
-                    })
-                    break
-            while True:
-                # Getting all responses up till now
-                try:
-                    responses.append(self.responses.get_nowait())
-                except queue.Empty:
-                    break
-            return {
-                'result': self.terminator.join(responses),
-                'events': events,
-            }
+            pos = buffer.find(terminator)
+            while pos >= 0 and self.framing is None:
+                line = str(buffer[:pos], self._decoding, 'replace')
+                del buffer[:pos + len(terminator)]
+                if line == self._framing_ack:
+                    self.framing = 'cobs'
+                    self.negotiated.set()
+                elif line != self._framing_line:
+                    self._put_line(line)
+                pos = buffer.find(terminator)
+
+    def _frame_received(self, frame: bytes):
+        try:
+            frame_type, session_id, data = framing.decode_frame(frame)
+        except framing.FrameError as e:
+            # Session of corrupted frame is unknown, it ends by timeout
+            event = {'error': f'Faulty frame ({e})', 'trace': frame.hex()}
+            self.logger.error(event)
+            self.metrics.faulty['frame'] += 1
+            self.events.append(event)
+            return
+        if frame_type not in (framing.LINE, framing.END, framing.ERROR):
+            # E.g. command frames echoed by device
+            return
+        if frame_type == framing.LINE:
+            self.metrics.lines_received += 1
+        text = str(data, self._decoding, 'replace')
+        session = self.session_ids.get(session_id)
+        buffer = self.sessions.get(session)
+        if buffer is None:
+            # Session 0 or session not waiting anymore
+            if frame_type == framing.LINE:
+                self._put_line(text)
+            elif frame_type == framing.ERROR:
+                event = {
+                    'error': f'Device error: {text}',
+                    'trace': frame.hex(),
+                }
+                self.logger.error(event)
+                self.events.append(event)
+            return
+        if len(buffer['events']) == 0:
+            buffer['events'].append({'event': 'begin', 'session': session})
+        if frame_type == framing.LINE:
+            buffer['responses'].append(text)
+            if buffer['on_line'] is not None:
+                buffer['on_line'](text)
+        elif frame_type == framing.END:
+            buffer['events'].append({'event': 'end', 'session': session})
+            buffer['done'].set()
+        elif frame_type == framing.ERROR:
+            buffer['events'].append({
+                'error': f'Device error: {text}',
+                'session': session,
+            })
+            buffer['done'].set()
+
+    def _encapsulate(self, session: str, cmd: str, buffer: Dict) -> bytes:
+        if self.framing == 'text':
+            return super(BinaryAutomataProtocol,
+                         self)._encapsulate(session, cmd, buffer)
+        # Ids of waiting sessions are skipped when ids wrap around
+        session_id = self.next_session_id
+        while session_id in self.session_ids:
+            session_id = session_id % framing.MAX_SESSION_ID + 1
+        self.next_session_id = session_id % framing.MAX_SESSION_ID + 1
+        self.session_ids[session_id] = session
+        buffer['session_id'] = session_id
+        self.logger.debug('Sending frame of session %s (id %d): %s', session,
+                          session_id, cmd)
+        return framing.encode_frame(
+            framing.CMD, session_id, cmd.encode(self.encoding,
+                                                self.encode_method))
+
+    def _close_session(self, session: str, buffer: Dict):
+        super(BinaryAutomataProtocol, self)._close_session(session, buffer)
+        self.session_ids.pop(buffer.get('session_id'), None)
 
 
 class ControlSocket:
     """
     Wrapper to socketio connection for remote communication to serial device
     """
-    def __init__(self, hub_addr: str, hub_port: int, serial_number: str):
+    def __init__(self,
+                 hub_addr: str,
+                 hub_port: int,
+                 serial_number: str,
+                 serial_factory: Callable[..., serial.SerialBase] = None,
+                 inventory: PortInventory = None):
         self.hub = {'addr': hub_addr, 'port': hub_port}
         self.serial_number = serial_number
         self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(LOG_LEVEL)
         self.sio = None
+        # Url of hub node to connect to instead, when asked by hub
+        self.relocation = None
+        self.telemetry = None
+        self.metrics = None
+        # Opening of comports and listing of available ones, replaceable by
+        # simulated devices
+        self.serial_factory = serial_factory or serial.serial_for_url
+        self.inventory = inventory or PortInventory(
+            self.logger, interval=COMPORTS_POLL_INTERVAL)
         self.serial_threads = {}
 
     def _available_comports(self) -> Dict:
         """
-        Get available serial ports
+        Get available serial ports, from the inventory kept up to date
         """
         try:
             return {
-                'result': [
-                    comport.__dict__
-                    for comport in list_ports.comports(include_links=True)
-                ]
+                'result': self.inventory.list(),
             }
         except:
             return {
@@ -216,43 +593,195 @@ class ControlSocket:
                     'encoding': port['protocol'].encoding,
                     'encode_method': port['protocol'].encode_method,
                     'terminator': port['protocol'].terminator,
+                    'max_inflight': port['protocol'].max_inflight,
+                    'framing': port['protocol'].framing,
                 },
             } for path, port in self.serial_threads.items()]
         }
 
+    def _comport_metrics(self) -> Dict[str, Dict]:
+        """
+        Metrics of connected comports, with the depth of their queues
+        """
+        return {
+            path: {
+                **port['protocol'].metrics.snapshot(),
+                'responses': len(port['protocol'].responses),
+                'events': len(port['protocol'].events),
+                'pending': port['workers'].pending,
+            }
+            for path, port in list(self.serial_threads.items())
+        }
+
+    def _protocol_error(self, framing_option: str,
+                        options: Dict) -> Optional[Dict[str, str]]:
+        """
+        Error response if protocol options are not valid for framing, the
+        protocol is created in the reader thread where errors are lost
+        """
+        allowed = COBS_OPTIONS if framing_option == 'cobs' else TEXT_OPTIONS
+        unknown = ', '.join(sorted(set(options) - allowed))
+        if unknown:
+            return {
+                'error': f'Unknown protocol options {unknown}',
+            }
+        for key in ('cmd_mark', 'terminator', 'encoding', 'encode_method'):
+            if key in options and (not isinstance(options[key], str)
+                                   or not options[key]):
+                return {
+                    'error': f'{key} must be a non-empty string',
+                }
+        try:
+            codecs.lookup(options.get('encoding', 'ascii'))
+            codecs.lookup_error(options.get('encode_method', 'replace'))
+        except LookupError as e:
+            return {
+                'error': f'Invalid encoding: {e}',
+            }
+        max_inflight = options.get('max_inflight', 1)
+        if (type(max_inflight) is not int
+                or not 1 <= max_inflight <= MAX_INFLIGHT):
+            return {
+                'error': f'max_inflight must be an integer from 1 to '
+                f'{MAX_INFLIGHT}',
+            }
+        timeout = options.get('negotiate_timeout', 1)
+        if type(timeout) not in (int, float) or timeout < 0:
+            return {
+                'error': 'negotiate_timeout must be a non-negative number',
+            }
+        return None
+
     def _connect_comport(self, comport: str, attributes: Dict,
                          protocol: Dict) -> Dict[str, str]:
         """
         Connect to specified serial comport.
         """
+        options = dict(protocol)
+        framing_option = options.pop('framing', 'text')
+        if framing_option == 'cobs':
+            protocol_class = BinaryAutomataProtocol
+        elif framing_option == 'text':
+            protocol_class = AutomataProtocol
+        else:
+            return {
+                'error': f'Unknown framing {framing_option}',
+            }
+        # Checked before reconfiguring too, options are applied in place
+        error = self._protocol_error(framing_option, options)
+        if error is not None:
+            return error
         if comport in self.serial_threads:
+            response = self._reconfigure_comport(comport, attributes,
+                                                 protocol_class, options)
+            if response is not None:
+                return response
             # Connect again with new attributes
             # Closing current connection first
             self._close_comport(comport)
         self.logger.debug(f'Connecting to {comport}...')
-        ser = serial.serial_for_url(comport, **attributes)
+        ser = self.serial_factory(comport, **attributes)
+        journal = self._open_journal(comport)
         reader = ReaderThread(
-            ser, lambda: AutomataProtocol(logger=self.logger, **protocol))
+            ser, lambda: protocol_class(
+                logger=self.logger, journal=journal, **options))
         reader.start()
         transport, protocol = reader.connect()
+        if self.telemetry is not None:
+            protocol.on_unsolicited = functools.partial(
+                self.telemetry.push, comport)
         self.serial_threads[comport] = {
             'attributes': attributes,
+            'options': options,
             'reader': reader,
             'transport': transport,
             'protocol': protocol,
+            'workers': ComportWorkers(comport,
+                                      self.logger,
+                                      workers=protocol.max_inflight,
+                                      max_pending=COMPORT_QUEUE_SIZE),
         }
+        if protocol_class is BinaryAutomataProtocol:
+            protocol.negotiate()
         return {
             'result': f'{comport} connected successfully',
+            'framing': protocol.framing,
         }
 
+    def _reconfigure_comport(self, comport: str, attributes: Dict,
+                             protocol_class: type,
+                             options: Dict) -> Optional[Dict[str, str]]:
+        """
+        Apply attributes and protocol options to the open connection of
+        comport, without closing it as reopening resets many boards.
+        Return None if the connection must be opened again: connection is
+        dead, framing changes or attributes cannot be changed on open port.
+        """
+        port = self.serial_threads[comport]
+        protocol = port['protocol']
+        if protocol.transport is None or type(protocol) is not protocol_class:
+            return None
+        if attributes == port['attributes'] and options == port['options']:
+            return {
+                'result': f'{comport} already connected with same settings',
+                'framing': protocol.framing,
+            }
+        if attributes != port['attributes']:
+            # Only settings of serial.Serial.get_settings() are changeable on
+            # open port, others are given when opening
+            defaults = serial.Serial().get_settings()
+            changed = {
+                key
+                for key in set(attributes) | set(port['attributes'])
+                if attributes.get(key) != port['attributes'].get(key)
+            }
+            if not changed <= set(defaults):
+                return None
+            try:
+                port['reader'].serial.apply_settings({
+                    key: attributes.get(key, defaults[key])
+                    for key in changed
+                })
+            except (ValueError, serial.SerialException) as e:
+                self.logger.warning(f'Cannot change settings of {comport} '
+                                    f'in place: {e}')
+                return None
+            port['attributes'] = attributes
+        if options != port['options']:
+            protocol.reconfigure(**options)
+            port['workers'].resize(protocol.max_inflight)
+            port['options'] = options
+        return {
+            'result': f'{comport} reconfigured without reopening',
+            'framing': protocol.framing,
+        }
+
+    def _open_journal(self, comport: str) -> Optional[Journal]:
+        """
+        Journal of traffic of comport if enabled, continuing the journal
+        recorded by previous connections
+        """
+        if not JOURNAL_DIR:
+            return None
+        try:
+            os.makedirs(JOURNAL_DIR, exist_ok=True)
+            return Journal(journal_path(JOURNAL_DIR, comport), JOURNAL_SIZE)
+        except OSError as e:
+            self.logger.error(f'Cannot open journal of {comport}: {e}')
+            return None
+
     def _close_comport(self, comport: str) -> Dict[str, str]:
         """
         Close specified serial comport.
         """
         if comport in self.serial_threads:
             self.logger.debug(f'Closing {comport}...')
-            self.serial_threads[comport]['reader'].close()
-            del self.serial_threads[comport]
+            port = self.serial_threads.pop(comport)
+            port['reader'].close()
+            if port['protocol'].journal is not None:
+                port['protocol'].journal.close()
+            # Commands still waiting fail as the comport is not attached
+            port['workers'].stop()
             return {
                 'result': f'{comport} closed successfully',
             }
@@ -262,8 +791,14 @@ class ControlSocket:
                 'error': f'{comport} not attached',
             }
 
-    def _comport_repl(self, session: str, cmd: str, comport: str,
-                      timeout: int) -> Dict:
+    def _comport_repl(self,
+                      session: str,
+                      cmd: str,
+                      comport: str,
+                      timeout: int,
+                      on_line: Callable[[str], None] = None,
+                      trace: Optional[Trace] = None,
+                      priority=CONTROL) -> Dict:
         """
         Send request to serial and get response
         """
@@ -271,33 +806,166 @@ class ControlSocket:
             return {
                 'error': f'{comport} not attached',
             }
+        elif self.serial_threads[comport]['protocol'].transport is None:
+            return {
+                'error': f'connection to {comport} is dead',
+            }
         else:
             return self.serial_threads[comport]['protocol'].send_cmd(
-                session, cmd, timeout=timeout)
+                session,
+                cmd,
+                timeout=timeout,
+                on_line=on_line,
+                trace=trace,
+                priority=priority)
+
+    def _submit(self,
+                comport: str,
+                job: Callable[[], None],
+                priority=CONTROL) -> Optional[Dict[str, str]]:
+        """
+        Queue job of priority to the workers of comport, return error if the
+        job cannot be queued
+        """
+        port = self.serial_threads.get(comport)
+        if port is None:
+            return {
+                'error': f'{comport} not attached',
+            }
+        if not port['workers'].submit(job, priority):
+            return {
+                'error': f'too many commands waiting for {comport}',
+            }
+        return None
+
+    def _comport_repl_batch(self, commands: List[Dict],
+                            done: Callable[[List[Dict]], None]):
+        """
+        Send multiple requests to serial ports and pass all responses to
+        `done`. Commands are executed in order for each comport by its
+        workers, and in parallel across comports. Other commands of a comport
+        are queued as one job with the lowest priority among them, emergency
+        commands are queued alone so they run ahead of them. Results are in
+        the order of commands.
+        """
+        def priority(command: Dict) -> int:
+            try:
+                return priority_of(command.get('priority'))
+            except ValueError:
+                return CONTROL
+
+        results = [None] * len(commands)
+        # Indexes of commands of each job, keyed by comport, or by comport
+        # and index for emergency commands
+        queues = {}
+        for index, command in enumerate(commands):
+            key = command['comport']
+            if priority(command) == EMERGENCY:
+                key = (key, index)
+            queues.setdefault(key, []).append(index)
+        if not queues:
+            # Nothing to wait for
+            done(results)
+            return
+        remaining = [len(queues)]
+        lock = threading.Lock()
+
+        def finish(indexes: List[int], execute: Callable[[Dict], Dict]):
+            for index in indexes:
+                command = commands[index]
+                results[index] = {
+                    'comport': command['comport'],
+                    'session': command['session'],
+                    **execute(command),
+                }
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            done(results)
+
+        def execute(command: Dict) -> Dict:
+            try:
+                command_priority = priority_of(command.get('priority'))
+            except ValueError as e:
+                return {'error': str(e)}
+            return self._comport_repl(session=command['session'],
+                                      cmd=command['cmd'],
+                                      comport=command['comport'],
+                                      timeout=int(command.get('timeout', 5)),
+                                      priority=command_priority)
+
+        for indexes in queues.values():
+            error = self._submit(
+                commands[indexes[0]]['comport'],
+                functools.partial(finish, indexes, execute),
+                max(priority(commands[index]) for index in indexes))
+            if error is not None:
+                finish(indexes, lambda command: error)
+
+    def _respond(self, message: Dict, response, trace: Trace = None):
+        """
+        Send response of request to management hub, with only the uuid and
+        node of the request instead of the whole request, and the stages of
+        the request if traced
+        """
+        reply = {
+            'uuid': message['uuid'],
+            'node': message.get('node'),
+            'response': response,
+        }
+        if trace is not None:
+            trace.mark('responded')
+            reply['trace'] = trace.stages
+        self.sio.emit('response', reply)
 
     def serve(self):
         """
         Start service
         """
         self.sio = socketio.Client(logger=self.logger,
-                                   engineio_logger=self.logger)
+                                   engineio_logger=self.logger,
+                                   serializer=SOCKETIO_SERIALIZER)
+        self.telemetry = TelemetryUplink(self.sio,
+                                         self.serial_number,
+                                         logger=self.logger,
+                                         interval=TELEMETRY_INTERVAL,
+                                         batch_size=TELEMETRY_BATCH_SIZE,
+                                         max_pending=TELEMETRY_MAX_PENDING)
+        self.metrics = MetricsUplink(self.sio,
+                                     self.serial_number,
+                                     self._comport_metrics,
+                                     logger=self.logger,
+                                     interval=METRICS_INTERVAL)
+
+        def comports_changed(changes: Dict):
+            if self.sio.connected:
+                self.sio.emit('comports_changed', {
+                    'serial_number': self.serial_number,
+                    **changes,
+                })
+
+        self.inventory.on_change = comports_changed
 
         @self.sio.event
         def connect():
             self.logger.debug('Connection established, joining serial room')
-            # Join serial room
-            self.sio.emit('join', {'serial_number': self.serial_number})
+            # Join serial room, with the comports hub may not know yet
+            self.sio.emit(
+                'join', {
+                    'serial_number': self.serial_number,
+                    'comports': self.inventory.list(),
+                })
 
         @self.sio.event
         def ping(message: str):
+            trace = start_trace(message)
             self.logger.debug(f'Received ping message: {message}')
-            self.sio.emit('response', {
-                'request': message,
-                'response': 'pong',
-            })
+            self._respond(message, 'pong', trace)
 
         @self.sio.event
         def comports(message: Dict):
+            trace = start_trace(message)
             self.logger.debug(f'Received comports message: {message}')
             cmd: str = message['content']['cmd']
             comport: str = message['content'].get('comport') or None
@@ -325,36 +993,97 @@ class ControlSocket:
             elif cmd == 'close' and comport is not None:
                 self.logger.debug(f'Attempt closing {comport}...')
                 response = self._close_comport(comport)
-            self.sio.emit('response', {
-                'request': message,
-                'response': response,
-            })
+            self._respond(message, response, trace)
 
         @self.sio.event
         def repl(message: Dict):
+            trace = start_trace(message)
             self.logger.debug(f'Received repl message: {message}')
             comport = message['content']['comport']
             session = message['content']['session']
             cmd = message['content']['cmd']
             timeout = int(message['content'].get('timeout', 5))
-            if self.serial_threads[comport]['protocol'].transport is not None:
-                response = self._comport_repl(session=session,
-                                              cmd=cmd,
-                                              comport=comport,
-                                              timeout=timeout)
-            else:
-                response = {'error': f'connection to {comport} is dead'}
-            self.sio.emit('response', {
-                'request': message,
-                'response': response,
-            })
+            try:
+                priority = priority_of(message['content'].get('priority'))
+            except ValueError as e:
+                self._respond(message, {'error': str(e)}, trace)
+                return
+            on_line = None
+            if message['content'].get('stream'):
+                # Forward each line of the session as soon as it arrives
+                def on_line(line: str):
+                    self.sio.emit('stream', {
+                        'uuid': message['uuid'],
+                        'node': message.get('node'),
+                        'line': line,
+                    })
+
+            def execute():
+                if trace is not None:
+                    trace.mark('started')
+                self._respond(
+                    message,
+                    self._comport_repl(session=session,
+                                       cmd=cmd,
+                                       comport=comport,
+                                       timeout=timeout,
+                                       on_line=on_line,
+                                       trace=trace,
+                                       priority=priority), trace)
+
+            if trace is not None:
+                trace.mark('queued')
+            # Executed by workers of comport, so slow commands do not block
+            # other comports and events
+            error = self._submit(comport, execute, priority)
+            if error is not None:
+                self._respond(message, error, trace)
+
+        @self.sio.event
+        def repl_batch(message: Dict):
+            trace = start_trace(message)
+            self.logger.debug(f'Received repl_batch message: {message}')
+            commands = message['content']['commands']
+            self._comport_repl_batch(
+                commands, lambda results: self._respond(
+                    message, {'result': results}, trace))
 
         @self.sio.event
         def disconnect():
             self.logger.debug('Disconnected from server')
 
-        self.sio.connect(f'{self.hub["addr"]}:{self.hub["port"]}')
-        self.sio.wait()
+        @self.sio.event
+        def relocate(message: Dict):
+            self.logger.info(f'Relocating to hub node {message["url"]}')
+            self.relocation = message['url']
+            self.sio.disconnect()
+
+        self.telemetry.start()
+        self.metrics.start()
+        self.inventory.start()
+        entry = f'{self.hub["addr"]}:{self.hub["port"]}'
+        url = entry
+        connected = False
+        while True:
+            self.relocation = None
+            # Only the entry point is reconnected to, robot losing the node it
+            # was relocated to goes back to the entry point, which relocates
+            # it to the new owner
+            self.sio.reconnection = url == entry
+            try:
+                # Serial number lets load balancer route robot to the same
+                # node
+                self.sio.connect(f'{url}?serial_number={self.serial_number}')
+            except socketio.exceptions.ConnectionError as e:
+                if not connected:
+                    raise
+                self.logger.warning(f'Cannot connect to {url}: {e}')
+                time.sleep(self.sio.reconnection_delay_max)
+                url = entry
+                continue
+            connected = True
+            self.sio.wait()
+            url = self.relocation or entry
 
 
 def serve(hub_addr=HUB_ADDR, hub_port=HUB_PORT, serial_number=SERIAL_NUMBER):
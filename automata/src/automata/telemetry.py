@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Uplink of unsolicited serial data to management hub
+"""
+
+import collections
+import logging
+import threading
+import time
+from typing import Deque, Dict, Tuple, Type
+
+import socketio
+
+
+class TelemetryUplink:
+    """
+    Collect lines received outside of sessions for each comport and ship them
+    to management hub in batches bounded by time and size.
+    Only one batch is sent at a time, the next one waits for the hub to
+    acknowledge the previous one. While waiting, at most `max_pending` lines
+    are kept for each comport and the oldest ones are dropped.
+    """
+    def __init__(self,
+                 sio: socketio.Client,
+                 serial_number: str,
+                 logger: Type[logging.Logger],
+                 interval=1.0,
+                 batch_size=100,
+                 max_pending=1000,
+                 ack_timeout=10.0):
+        self.sio = sio
+        self.serial_number = serial_number
+        self.logger = logger
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.ack_timeout = ack_timeout
+        self.pending: Dict[str, Deque[Tuple[float, str]]] = {}
+        self.dropped: Dict[str, int] = {}
+        self.condition = threading.Condition()
+        self.acked = threading.Event()
+        self.acked.set()
+        self.running = False
+        self.thread = None
+
+    def push(self, comport: str, line: str):
+        """
+        Store line received from comport, to be sent with next batch
+        """
+        with self.condition:
+            lines = self.pending.get(comport)
+            if lines is None:
+                lines = self.pending[comport] = collections.deque(
+                    maxlen=self.max_pending)
+                self.dropped[comport] = 0
+            if len(lines) == self.max_pending:
+                self.dropped[comport] += 1
+            lines.append((time.time(), line))
+            if len(lines) >= self.batch_size:
+                self.condition.notify()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _collect(self) -> Dict[str, Dict]:
+        """
+        Take up to `batch_size` lines of each comport
+        """
+        batch = {}
+        with self.condition:
+            for comport, lines in self.pending.items():
+                if len(lines) == 0 and self.dropped[comport] == 0:
+                    continue
+                count = min(len(lines), self.batch_size)
+                batch[comport] = {
+                    'lines': [lines.popleft() for _ in range(count)],
+                    'dropped': self.dropped[comport],
+                }
+                self.dropped[comport] = 0
+        return batch
+
+    def _acknowledge(self, *args):
+        self.acked.set()
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait(timeout=self.interval)
+            # Backpressure: do not send until previous batch is acknowledged
+            if not self.acked.wait(timeout=self.ack_timeout):
+                self.logger.warning('Telemetry batch not acknowledged after '
+                                    f'{self.ack_timeout}s')
+            if not self.sio.connected:
+                continue
+            batch = self._collect()
+            if len(batch) == 0:
+                continue
+            self.acked.clear()
+            message = {
+                'serial_number': self.serial_number,
+                'comports': batch,
+            }
+            try:
+                self.sio.emit('telemetry', message, callback=self._acknowledge)
+            except socketio.exceptions.SocketIOError as e:
+                self.logger.warning(f'Cannot send telemetry batch: {e}')
+                self.acked.set()
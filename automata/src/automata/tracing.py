@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the stages of requests traced by management hub
+"""
+
+import time
+from typing import Dict, Optional
+
+
+class Trace:
+    """
+    Monotonic timestamps of the stages of a traced request, in milliseconds
+    since the request was received. Stages are sent back with the response
+    for the hub to make spans of them.
+    """
+    __slots__ = ('start', 'stages')
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages: Dict[str, float] = {}
+
+    def mark(self, stage: str):
+        self.stages[stage] = (time.monotonic() - self.start) * 1000
+
+
+def start_trace(message: Dict) -> Optional[Trace]:
+    """
+    Trace of request if hub asked to trace it, else None
+    """
+    return Trace() if message.get('trace') else None
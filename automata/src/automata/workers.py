@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Worker threads executing commands of a serial port
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+from typing import Callable, List, Optional, Tuple, Type
+
+from .scheduling import BULK, CONTROL, EMERGENCY
+
+# Priority of the entries stopping workers, after all jobs already queued
+STOP = BULK + 1
+
+
+class ComportWorkers:
+    """
+    Bounded queue of jobs of a comport, executed by worker threads in order
+    of priority, then in order of submission. There should be as many
+    workers as sessions allowed to wait for response on the comport
+    (`max_inflight`), so pipelined sessions are sent while others wait. One
+    more worker only executes emergency jobs, so they do not wait for a
+    worker busy with other jobs. Jobs submitted when `max_pending` jobs are
+    waiting are rejected, except emergency jobs.
+    """
+    def __init__(self,
+                 comport: str,
+                 logger: Type[logging.Logger],
+                 workers=1,
+                 max_pending=100):
+        self.comport = comport
+        self.logger = logger
+        self.max_pending = max_pending
+        self.pending = 0
+        # Jobs as (priority, submission, job), job None stops one worker
+        self.jobs: List[Tuple[int, int, Optional[Callable[[], None]]]] = []
+        self.submissions = itertools.count()
+        self.condition = threading.Condition()
+        self.workers = 0
+        self.emergency_worker = False
+        self.resize(workers)
+
+    def submit(self, job: Callable[[], None], priority=CONTROL) -> bool:
+        """
+        Queue job, return False if too many jobs are waiting
+        """
+        with self.condition:
+            if self.pending >= self.max_pending and priority != EMERGENCY:
+                return False
+            self.pending += 1
+            heapq.heappush(self.jobs,
+                           (priority, next(self.submissions), job))
+            self.condition.notify_all()
+        return True
+
+    def resize(self, workers: int):
+        """
+        Change number of workers, extra workers stop after the jobs already
+        queued
+        """
+        with self.condition:
+            for _ in range(workers, self.workers):
+                heapq.heappush(self.jobs,
+                               (STOP, next(self.submissions), None))
+            for _ in range(self.workers, workers):
+                threading.Thread(target=self._run, daemon=True).start()
+            self.workers = workers
+            if workers > 0 and not self.emergency_worker:
+                self.emergency_worker = True
+                threading.Thread(target=self._run,
+                                 args=(EMERGENCY, ),
+                                 daemon=True).start()
+            self.condition.notify_all()
+
+    def stop(self):
+        """
+        Stop all workers after the jobs already queued
+        """
+        self.resize(0)
+
+    def _next(self, highest: int) -> Optional[Callable[[], None]]:
+        """
+        Wait for the next job of priority up to `highest`, None when the
+        worker should stop
+        """
+        with self.condition:
+            while True:
+                if self.jobs and self.jobs[0][0] <= highest:
+                    return heapq.heappop(self.jobs)[2]
+                if highest == EMERGENCY and self.workers == 0:
+                    self.emergency_worker = False
+                    return None
+                self.condition.wait()
+
+    def _run(self, highest=STOP):
+        while True:
+            job = self._next(highest)
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                self.logger.error(f'Job of {self.comport} failed: {e}')
+            finally:
+                with self.condition:
+                    self.pending -= 1
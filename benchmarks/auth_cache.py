@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of http basic authentication with and without credential cache.
+
+Sends requests to the ping route of an offline robot using Flask's test
+client, so the measured time is mostly authentication, and reports the
+number of requests per second for email+password and token credentials.
+
+Run from the hub sub-project so its dependencies are available:
+
+    cd hub && poetry run python ../benchmarks/auth_cache.py
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'hub', 'src'))
+
+from app import create_app, credentials, db  # noqa: E402
+from app.models import User  # noqa: E402
+
+
+def basic_auth(username: str, password: str) -> dict:
+    encoded = base64.b64encode(f'{username}:{password}'.encode('utf-8'))
+    return {'Authorization': f'Basic {encoded.decode("ascii")}'}
+
+
+def run(client, headers: dict, requests: int) -> float:
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get('/api/v0/automata/benchmark/ping', headers=headers)
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    app, _ = create_app('test')
+    with app.app_context():
+        db.create_all()
+        user = User(email='benchmark@example.com',
+                    username='benchmark',
+                    password='benchmark',
+                    confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        token = user.generate_auth_token(expiration=3600)
+    client = app.test_client()
+    cases = {
+        'password': basic_auth('benchmark@example.com', 'benchmark'),
+        'token': basic_auth(token, ''),
+    }
+
+    print(f'{"credentials":>12} {"cache":>6} {"requests/s":>12}')
+    for name, headers in cases.items():
+        for size in (0, app.config['AUTH_CACHE_SIZE'] or 1024):
+            credentials.size = size
+            credentials.entries.clear()
+            credentials.users.clear()
+            rate = run(client, headers, args.requests)
+            print(f'{name:>12} {"on" if size else "off":>6} {rate:>12,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of AutomataProtocol.data_received throughput.
+
+Feeds pre-generated serial traffic to the protocol in chunks sized like what
+pyserial's ReaderThread reads at different baud rates and reports the number
+of lines processed per second.
+
+With `--journal`, the data received in a journal of serial traffic
+recorded by the service (`JOURNAL_DIR`) is replayed instead, in the chunks
+it was received.
+
+Run from the automata sub-project so its dependencies are available:
+
+    cd automata && poetry run python ../benchmarks/data_received.py
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'automata', 'src'))
+
+from automata.journal import HEADER, RECEIVED, Journal  # noqa: E402
+from automata.service import AutomataProtocol  # noqa: E402
+
+# Chunk sizes approximating bytes available per read of ReaderThread
+PROFILES = {
+    '115200': 32,
+    '1M': 4096,
+}
+
+
+def generate_traffic(lines: int, line_length: int, sessions: int) -> bytes:
+    """
+    Build traffic made of `sessions` sessions, each wrapping `lines` lines
+    """
+    payload = b'x' * line_length + b'\n'
+    chunks = []
+    for i in range(sessions):
+        chunks.append(f'!BEGIN bench{i}\n'.encode('ascii'))
+        chunks.append(payload * lines)
+        chunks.append(f'!END bench{i}\n'.encode('ascii'))
+    return b''.join(chunks)
+
+
+def journal_chunks(path: str) -> List[bytes]:
+    """
+    Chunks of data received in journal, oldest first
+    """
+    journal = Journal(path, os.path.getsize(path) - HEADER.size, create=False)
+    try:
+        return [
+            data for _, direction, data in journal.records()
+            if direction == RECEIVED
+        ]
+    finally:
+        journal.close()
+
+
+def run(traffic: bytes, chunk_size: int, rounds: int) -> float:
+    """
+    Return the best number of lines per second among the rounds
+    """
+    chunks = [
+        traffic[i:i + chunk_size] for i in range(0, len(traffic), chunk_size)
+    ]
+    return run_chunks(chunks, rounds)
+
+
+def run_chunks(chunks: List[bytes], rounds: int) -> float:
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(logging.INFO)
+    line_count = sum(chunk.count(b'\n') for chunk in chunks)
+    best = 0.0
+    for _ in range(rounds):
+        protocol = AutomataProtocol(logger=logger)
+        start = time.perf_counter()
+        for chunk in chunks:
+            protocol.data_received(chunk)
+        elapsed = time.perf_counter() - start
+        best = max(best, line_count / elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--lines', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--line-lengths',
+                        type=int,
+                        nargs='+',
+                        default=[16, 80, 4096])
+    parser.add_argument('--journal', help='replay journal of serial traffic')
+    args = parser.parse_args()
+
+    if args.journal:
+        rate = run_chunks(journal_chunks(args.journal), args.rounds)
+        print(f'{"journal":>8} {rate:>12,.0f} lines/s')
+        return
+
+    print(f'{"profile":>8} {"chunk":>6} {"line":>6} {"lines/s":>12}')
+    for profile, chunk_size in PROFILES.items():
+        for line_length in args.line_lengths:
+            traffic = generate_traffic(args.lines, line_length, args.sessions)
+            rate = run(traffic, chunk_size, args.rounds)
+            print(f'{profile:>8} {chunk_size:>6} {line_length:>6} '
+                  f'{rate:>12,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the automata service and the management hub.
+
+Runs everything in one process, without hardware nor network services: a
+simulated board on a pseudo terminal (or pyserial's `loop://`), a
+ControlSocket connected to a hub made by `create_app('test')` and served on
+localhost. Reports:
+
+- `send_cmd`: round-trip latency of commands sent by the service
+- `data_received`: lines per second received from the board by the service
+- `hub_<route>_c<clients>`: latency of REST requests relayed to the robot by
+  `socket_send_receive`, with concurrent HTTP clients
+
+Like the deployed hub, the process runs on eventlet green threads. Results
+are written as JSON with the current commit, and compared with results of
+another commit if given:
+
+    python ../benchmarks/e2e.py --output after.json --compare before.json
+
+Run with the dependencies of both sub-projects installed.
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List
+
+import eventlet
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'hub', 'src'))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'automata', 'src'))
+
+# Hub first, as it patches the standard library for eventlet
+from app import create_app, db, presence  # noqa: E402
+from app.models import Robot, RoboticRole, RobotUser, User  # noqa: E402
+from automata.service import ControlSocket  # noqa: E402
+from reporting import percentiles, report  # noqa: E402
+from simulator import PtyFirmware  # noqa: E402
+
+SERIAL_NUMBER = 'benchmark'
+EMAIL = 'benchmark@example.com'
+PASSWORD = 'benchmark'
+
+
+def setup_hub(port: int):
+    """
+    Hub with a user administering the benchmark robot, served on localhost
+    """
+    app, socketio = create_app('test')
+    app.logger.setLevel(logging.WARNING)
+    with app.app_context():
+        db.create_all()
+        RoboticRole.insert_roles()
+        user = User(email=EMAIL,
+                    username='benchmark',
+                    password=PASSWORD,
+                    confirmed=True)
+        robot = Robot(name='benchmark', serial=SERIAL_NUMBER)
+        db.session.add_all([user, robot])
+        db.session.commit()
+        role = RoboticRole.query.filter_by(name='Administrator').first()
+        db.session.add(
+            RobotUser(user_id=user.id, robot_id=robot.id, role_id=role.id))
+        db.session.commit()
+    eventlet.spawn(socketio.run,
+                   app,
+                   host='127.0.0.1',
+                   port=port,
+                   log_output=False)
+    return app
+
+
+def setup_robot(port: int) -> ControlSocket:
+    """
+    Service connected to the hub, waiting until its room is joined
+    """
+    control = ControlSocket(hub_addr='http://127.0.0.1',
+                            hub_port=port,
+                            serial_number=SERIAL_NUMBER)
+    control.logger.setLevel(logging.WARNING)
+    threading.Thread(target=control.serve, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not presence.is_online(SERIAL_NUMBER):
+        if time.monotonic() > deadline:
+            raise RuntimeError('robot did not join the hub')
+        time.sleep(0.05)
+    return control
+
+
+def bench_send_cmd(control: ControlSocket, comport: str, commands: int,
+                   warmup: int) -> Dict:
+    samples = []
+    for i in range(warmup + commands):
+        start = time.perf_counter()
+        response = control._comport_repl(session=f'cmd{i}',
+                                         cmd=f'ping {i}',
+                                         comport=comport,
+                                         timeout=5)
+        elapsed = time.perf_counter() - start
+        errors = [e for e in response.get('events', []) if 'error' in e]
+        if 'error' in response or errors:
+            raise RuntimeError(f'send_cmd failed: {response}')
+        if i >= warmup:
+            samples.append(elapsed)
+    return percentiles(samples)
+
+
+def bench_data_received(control: ControlSocket, comport: str, loop: bool,
+                        lines: int, line_length: int, rounds: int) -> Dict:
+    """
+    Best rate of receiving a session of `lines` lines, the board generates
+    them, or they are echoed back by `loop://`
+    """
+    if loop:
+        cmd = '\n'.join(['x' * line_length] * lines)
+    else:
+        cmd = f'stream {lines} {line_length}'
+    best = math.inf
+    for i in range(rounds):
+        start = time.perf_counter()
+        response = control._comport_repl(session=f'stream{i}',
+                                         cmd=cmd,
+                                         comport=comport,
+                                         timeout=60)
+        elapsed = time.perf_counter() - start
+        received = response.get('result', '').count('x' * line_length)
+        if received != lines:
+            raise RuntimeError(f'received {received} of {lines} lines')
+        best = min(best, elapsed)
+    return {
+        'lines': lines,
+        'line_length': line_length,
+        'lines_per_s': lines / best,
+        'bytes_per_s': lines * (line_length + 1) / best,
+    }
+
+
+def http_client(port: int, headers: Dict, requests: int,
+                request: Callable[[int], tuple], samples: List[float],
+                errors: List[str]):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        for i in range(requests):
+            method, path, body = request(i)
+            start = time.perf_counter()
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+            samples.append(time.perf_counter() - start)
+            if response.status != 200:
+                errors.append(content.decode('utf-8', 'replace'))
+    finally:
+        connection.close()
+
+
+def bench_hub(port: int, comport: str, route: str, clients: int,
+              requests: int) -> Dict:
+    encoded = base64.b64encode(f'{EMAIL}:{PASSWORD}'.encode('utf-8'))
+    headers = {
+        'Authorization': f'Basic {encoded.decode("ascii")}',
+        'Content-Type': 'application/json',
+    }
+    prefix = f'/api/v0/automata/{SERIAL_NUMBER}'
+
+    def requester(client: int) -> Callable[[int], tuple]:
+        if route == 'ping':
+            return lambda i: ('GET', f'{prefix}/ping', None)
+        # Sessions waiting at the same time must differ
+        return lambda i: ('POST', f'{prefix}/repl',
+                          json.dumps({
+                              'comport': comport,
+                              'session': f'c{client}r{i}',
+                              'cmd': f'ping {i}',
+                          }))
+
+    samples, errors = [], []
+    # Not measured, credentials are verified and cached by the first request
+    http_client(port, headers, 1, requester(0), [], errors)
+    threads = [
+        threading.Thread(target=http_client,
+                         args=(port, headers, requests, requester(client),
+                               samples, errors)) for client in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise RuntimeError(f'{len(errors)} {route} requests failed, '
+                           f'first: {errors[0]}')
+    return {
+        'clients': clients,
+        'requests_per_s': len(samples) / elapsed,
+        **percentiles(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--serial',
+                        choices=['pty', 'loop'],
+                        default='pty',
+                        help='simulated board on a pseudo terminal, or '
+                        'pyserial loop:// echoing commands back (much slower '
+                        'to read, byte by byte)')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--commands', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--line-length', type=int, default=80)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--clients',
+                        type=int,
+                        nargs='+',
+                        default=[1, 8, 32])
+    parser.add_argument('--requests',
+                        type=int,
+                        default=100,
+                        help='requests per client')
+    parser.add_argument('--output', help='write results as JSON to file')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    board = None
+    if args.serial == 'pty':
+        board = PtyFirmware()
+        board.start()
+        comport = board.path
+    else:
+        comport = 'loop://'
+    setup_hub(args.port)
+    control = setup_robot(args.port)
+    response = control._connect_comport(comport, {'baudrate': 115200}, {})
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+
+    results = {}
+    results['send_cmd'] = bench_send_cmd(control, comport, args.commands,
+                                         args.warmup)
+    results['data_received'] = bench_data_received(control, comport,
+                                                   args.serial == 'loop',
+                                                   args.lines,
+                                                   args.line_length,
+                                                   args.rounds)
+    for route in ('ping', 'repl'):
+        for clients in args.clients:
+            results[f'hub_{route}_c{clients}'] = bench_hub(
+                args.port, comport, route, clients, args.requests)
+    control._close_comport(comport)
+    control.sio.disconnect()
+    if board is not None:
+        board.stop()
+
+    print(f'{"benchmark":<16} {"count":>7} {"p50 ms":>8} {"p90 ms":>8} '
+          f'{"p99 ms":>8} {"max ms":>8} {"per s":>10}')
+    for name, result in results.items():
+        if 'count' not in result:
+            continue
+        rate = result.get('requests_per_s')
+        print(f'{name:<16} {result["count"]:>7} {result["p50_ms"]:>8.2f} '
+              f'{result["p90_ms"]:>8.2f} {result["p99_ms"]:>8.2f} '
+              f'{result["max_ms"]:>8.2f} '
+              f'{"" if rate is None else f"{rate:,.0f}":>10}')
+    received = results['data_received']
+    print(f'data_received: {received["lines_per_s"]:,.0f} lines/s, '
+          f'{received["bytes_per_s"]:,.0f} bytes/s '
+          f'({received["line_length"]} bytes per line)')
+
+    report(results, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load generator simulating a fleet of robots for hub scaling tests.
+
+Each simulated robot is a ControlSocket of the automata service, with its
+usual event handlers, whose serial ports are in-memory simulated boards
+answering after `--latency` ms with `--payload` extra characters. Robots
+are launched on eventlet green threads, so thousands fit in one process.
+Once they joined, concurrent HTTP clients send requests of the `--mix` to
+the `/api/v0/automata/...` routes for random robots.
+
+Reports the number of robots connected and online on the hub, their
+connection time, and the throughput and latency of each route, written as
+JSON to compare hub configurations (`--label`) or commits.
+
+Register the robots and their user in the database of the hub first, with
+the same environment as the hub, then start the hub to test:
+
+    cd hub && poetry run python ../benchmarks/fleet.py setup --robots 1000
+    python ../benchmarks/fleet.py run --hub http://127.0.0.1:5000 \\
+        --robots 1000 --clients 50 --duration 30 --label eventlet
+
+Run with the dependencies of both sub-projects installed.
+"""
+
+import eventlet
+
+eventlet.monkey_patch()
+
+import argparse  # noqa: E402
+import base64  # noqa: E402
+import http.client  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import random  # noqa: E402
+import resource  # noqa: E402
+import sys  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+from typing import Dict, List  # noqa: E402
+from urllib.parse import urlsplit  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'hub', 'src'))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'automata', 'src'))
+
+from automata.service import ControlSocket  # noqa: E402
+from reporting import percentiles, report  # noqa: E402
+from simulator import Firmware, FirmwareSerial  # noqa: E402
+
+COMPORT = 'sim://0'
+ROUTES = ('ping', 'repl', 'comports', 'physical_ports')
+
+
+class StaticInventory:
+    """
+    Serial ports of simulated robot, never changing
+    """
+    def __init__(self, ports: int):
+        self.on_change = None
+        self.ports = [{
+            'device': f'sim://{i}',
+            'name': f'sim{i}',
+            'description': 'Simulated board',
+            'hwid': f'SIM{i}',
+        } for i in range(ports)]
+
+    def list(self) -> List[Dict]:
+        return self.ports
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def serial_number(prefix: str, index: int) -> str:
+    return f'{prefix}-{index:05d}'
+
+
+def setup(args):
+    """
+    Register robots and the user operating them in the database of the hub
+    """
+    from app import create_app, db
+    from app.models import Robot, RoboticRole, RobotUser, User
+    app, _ = create_app(args.config)
+    with app.app_context():
+        db.create_all()
+        RoboticRole.insert_roles()
+        user = User.query.filter_by(email=args.email).first()
+        if user is None:
+            user = User(email=args.email,
+                        username=args.email.split('@')[0],
+                        password=args.password,
+                        confirmed=True)
+            db.session.add(user)
+            db.session.commit()
+        role = RoboticRole.query.filter_by(name='Operator').first()
+        existing = {
+            serial
+            for serial, in db.session.query(Robot.serial).filter(
+                Robot.serial.like(f'{args.prefix}-%'))
+        }
+        added = 0
+        for index in range(args.robots):
+            serial = serial_number(args.prefix, index)
+            if serial in existing:
+                continue
+            robot = Robot(name=serial, serial=serial)
+            db.session.add(robot)
+            db.session.flush()
+            db.session.add(
+                RobotUser(user_id=user.id, robot_id=robot.id,
+                          role_id=role.id))
+            added += 1
+        db.session.commit()
+    print(f'{added} robots registered, {len(existing)} already registered')
+
+
+def launch(args, index: int, failures: List[str]) -> ControlSocket:
+    """
+    Start simulated robot, connecting to hub in background
+    """
+    hub = urlsplit(args.hub)
+
+    def open_board(port: str, **attributes) -> FirmwareSerial:
+        return FirmwareSerial(port,
+                              Firmware(payload=args.payload),
+                              latency=args.latency / 1000,
+                              **attributes)
+
+    control = ControlSocket(hub_addr=f'{hub.scheme}://{hub.hostname}',
+                            hub_port=hub.port,
+                            serial_number=serial_number(args.prefix, index),
+                            serial_factory=open_board,
+                            inventory=StaticInventory(args.ports))
+    # Disconnections of thousands of robots are expected
+    control.logger.setLevel(logging.ERROR)
+    control._connect_comport(COMPORT, {}, {})
+
+    def serve():
+        try:
+            control.serve()
+        except Exception as e:
+            failures.append(f'{control.serial_number}: {e}')
+
+    threading.Thread(target=serve, daemon=True).start()
+    return control
+
+
+def connect_fleet(args) -> tuple:
+    """
+    Launch robots at `--ramp` robots per second and wait for them to
+    connect, return robots and connection report
+    """
+    failures = []
+    started = {}
+    robots = []
+    samples = []
+    launching = True
+
+    def watch():
+        deadline = None
+        while launching or started:
+            now = time.perf_counter()
+            for robot in list(started):
+                if robot.sio is not None and robot.sio.connected:
+                    samples.append(now - started.pop(robot))
+            if not launching:
+                deadline = deadline or time.monotonic() + args.join_timeout
+                if time.monotonic() > deadline:
+                    return
+            time.sleep(0.02)
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    for index in range(args.robots):
+        robot = launch(args, index, failures)
+        robots.append(robot)
+        started[robot] = time.perf_counter()
+        time.sleep(1 / args.ramp)
+    launching = False
+    watcher.join()
+    connected = [robot for robot in robots if robot not in started]
+    return connected, {
+        'launched': len(robots),
+        'connected': len(connected),
+        'failed': len(failures),
+        'connect': percentiles(samples),
+    }, failures
+
+
+class Client:
+    """
+    HTTP client of the fleet user, reconnecting after errors
+    """
+    def __init__(self, args):
+        hub = urlsplit(args.hub)
+        self.host = hub.hostname
+        self.port = hub.port
+        encoded = base64.b64encode(
+            f'{args.email}:{args.password}'.encode('utf-8'))
+        self.headers = {
+            'Authorization': f'Basic {encoded.decode("ascii")}',
+        }
+        self.connection = None
+
+    def request(self, method: str, path: str, body: Dict = None) -> tuple:
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host,
+                                                         self.port,
+                                                         timeout=30)
+        try:
+            if body is None:
+                self.connection.request(method, path, headers=self.headers)
+            else:
+                self.connection.request(method,
+                                        path,
+                                        body=json.dumps(body),
+                                        headers={
+                                            **self.headers,
+                                            'Content-Type': 'application/json',
+                                        })
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.connection.close()
+            self.connection = None
+            return None, str(e).encode('utf-8')
+
+
+def online_count(args) -> int:
+    status, content = Client(args).request('GET', '/api/v0/automata/online')
+    if status != 200:
+        raise RuntimeError(f'cannot list online robots: {content}')
+    return sum(robot['serial_number'].startswith(f'{args.prefix}-')
+               for robot in json.loads(content)['result'])
+
+
+def drive_traffic(args, serials: List[str]) -> Dict:
+    """
+    Send requests of the mix for random robots from concurrent clients
+    during `--duration` seconds
+    """
+    routes, weights = zip(*args.mix.items())
+    samples = {route: [] for route in routes}
+    errors = {route: 0 for route in routes}
+    first_errors = []
+    deadline = time.monotonic() + args.duration
+
+    def run(client_id: int):
+        client = Client(args)
+        i = 0
+        while time.monotonic() < deadline:
+            route = random.choices(routes, weights)[0]
+            prefix = f'/api/v0/automata/{random.choice(serials)}'
+            body = None
+            if route == 'repl':
+                method, path = 'POST', f'{prefix}/repl'
+                # Sessions waiting at the same time on a comport must differ
+                body = {
+                    'comport': COMPORT,
+                    'session': f'c{client_id}r{i}',
+                    'cmd': f'ping {i}',
+                }
+            else:
+                method, path = 'GET', f'{prefix}/{route}'
+            start = time.perf_counter()
+            status, content = client.request(method, path, body)
+            elapsed = time.perf_counter() - start
+            i += 1
+            if status != 200:
+                errors[route] += 1
+                if len(first_errors) < 5:
+                    first_errors.append(f'{route} {status}: {content[:200]}')
+                continue
+            samples[route].append(elapsed)
+
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=run, args=(client, ))
+        for client in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    results = {
+        route: {
+            'requests_per_s': len(samples[route]) / elapsed,
+            'errors': errors[route],
+            **percentiles(samples[route]),
+        }
+        for route in routes
+    }
+    results['total'] = {
+        'requests_per_s': sum(map(len, samples.values())) / elapsed,
+        'errors': sum(errors.values()),
+        **percentiles([s for route in routes for s in samples[route]]),
+    }
+    for error in first_errors:
+        print(f'error: {error}')
+    return results
+
+
+def mix(value: str) -> Dict[str, float]:
+    """
+    Weights of routes, e.g. `ping=4,repl=4,comports=1,physical_ports=1`
+    """
+    weights = {}
+    for item in value.split(','):
+        route, _, weight = item.partition('=')
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f'unknown route {route}')
+        weights[route] = float(weight or 1)
+    return weights
+
+
+def run(args):
+    # Each robot holds a connection to hub, and each client one
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    logging.getLogger().setLevel(logging.WARNING)
+
+    connected, fleet, failures = connect_fleet(args)
+    for failure in failures[:5]:
+        print(f'failure: {failure}')
+    fleet['online'] = online_count(args)
+    print(f'{fleet["connected"]}/{fleet["launched"]} robots connected, '
+          f'{fleet["online"]} online on hub, {fleet["failed"]} failed, '
+          f'connection p50 {fleet["connect"].get("p50_ms", 0):.0f} ms, '
+          f'p99 {fleet["connect"].get("p99_ms", 0):.0f} ms')
+    if not connected:
+        raise RuntimeError('no robot connected')
+
+    routes = drive_traffic(args, [robot.serial_number for robot in connected])
+    print(f'{"route":<16} {"count":>7} {"errors":>7} {"p50 ms":>8} '
+          f'{"p90 ms":>8} {"p99 ms":>8} {"max ms":>8} {"per s":>10}')
+    for route, result in routes.items():
+        if result['count'] == 0:
+            print(f'{route:<16} {0:>7} {result["errors"]:>7}')
+            continue
+        print(f'{route:<16} {result["count"]:>7} {result["errors"]:>7} '
+              f'{result["p50_ms"]:>8.2f} {result["p90_ms"]:>8.2f} '
+              f'{result["p99_ms"]:>8.2f} {result["max_ms"]:>8.2f} '
+              f'{result["requests_per_s"]:>10,.0f}')
+
+    for robot in connected:
+        eventlet.spawn(robot.sio.disconnect)
+    report({'fleet': fleet, 'routes': routes}, args, label=args.label)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command in (commands.add_parser('setup',
+                                        help='register robots in database'),
+                    commands.add_parser('run', help='run the fleet')):
+        command.add_argument('--robots', type=int, default=100)
+        command.add_argument('--prefix',
+                             default='fleet',
+                             help='prefix of robot serial numbers')
+        command.add_argument('--email', default='fleet@example.com')
+        command.add_argument('--password', default='fleet')
+    commands.choices['setup'].add_argument(
+        '--config', default=os.getenv('FLASK_CONFIG') or 'default')
+    command = commands.choices['run']
+    command.add_argument('--hub', default='http://127.0.0.1:5000')
+    command.add_argument('--label',
+                         default='',
+                         help='name of the hub configuration tested')
+    command.add_argument('--ramp',
+                         type=float,
+                         default=100,
+                         help='robots launched per second')
+    command.add_argument('--join-timeout', type=float, default=60)
+    command.add_argument('--ports',
+                         type=int,
+                         default=4,
+                         help='serial ports listed by each robot')
+    command.add_argument('--latency',
+                         type=float,
+                         default=0,
+                         help='ms before simulated boards answer')
+    command.add_argument('--payload',
+                         type=int,
+                         default=0,
+                         help='characters added to each answer')
+    command.add_argument('--clients', type=int, default=20)
+    command.add_argument('--duration', type=float, default=10)
+    command.add_argument('--mix',
+                         type=mix,
+                         default='ping=4,repl=4,comports=1,physical_ports=1')
+    command.add_argument('--output', help='write results as JSON to file')
+    command.add_argument('--compare', help='JSON results to compare with')
+    args = parser.parse_args()
+    if args.command == 'setup':
+        setup(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
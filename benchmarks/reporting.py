@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Machine-readable results of benchmarks, comparable between commits
+"""
+
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+from typing import Dict, List
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    Summary of latencies in seconds, in milliseconds (nearest rank)
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+
+    def rank(p: float) -> float:
+        return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'p50_ms': rank(50),
+        'p90_ms': rank(90),
+        'p99_ms': rank(99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def flatten(results: Dict, prefix='') -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, float):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(baseline: Dict, current: Dict):
+    """
+    Print metrics of both results side by side
+    """
+    old = flatten(baseline['results'])
+    new = flatten(current['results'])
+    print(f'\nCompared with {baseline["meta"]["commit"]}:')
+    print(f'{"metric":<40} {"baseline":>14} {"current":>14} {"change":>8}')
+    for key, value in new.items():
+        if key not in old:
+            continue
+        change = (value - old[key]) / old[key] * 100 if old[key] else 0
+        print(f'{key:<40} {old[key]:>14,.2f} {value:>14,.2f} '
+              f'{change:>+7.1f}%')
+
+
+def report(results: Dict, args, **meta) -> Dict:
+    """
+    Write results with the commit and arguments to `args.output` if set,
+    and compare them with the results in `args.compare` if set
+    """
+    report = {
+        'meta': {
+            'commit': commit(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            **meta,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), report)
+    return report
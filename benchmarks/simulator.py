@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Firmware simulator for benchmarks, answering the `!BEGIN`/`!END` session
+protocol of the automata service like a board running the usual sketch.
+
+Lines of a session are echoed back, as `arduino_simulator.sh` does, except
+`stream <lines> <length>` which answers with `lines` lines of `length`
+characters to generate traffic from the device.
+"""
+
+import collections
+import os
+import select
+import threading
+import time
+import tty
+
+
+class Firmware:
+    """
+    Line protocol of the simulated board, independent of the transport
+    """
+    def __init__(self, cmd_mark='!', terminator='\n', payload=0):
+        self.cmd_mark = cmd_mark.encode('ascii')
+        self.terminator = terminator.encode('ascii')
+        # Characters of the line added to the answer of each command
+        self.payload = b'x' * payload + self.terminator if payload else b''
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> bytes:
+        """
+        Process bytes written by the service, return bytes to send back
+        """
+        self.buffer += data
+        output = []
+        start = 0
+        pos = self.buffer.find(self.terminator)
+        while pos >= 0:
+            output.append(self.answer(bytes(self.buffer[start:pos])))
+            start = pos + len(self.terminator)
+            pos = self.buffer.find(self.terminator, start)
+        del self.buffer[:start]
+        return b''.join(output)
+
+    def answer(self, line: bytes) -> bytes:
+        if line.startswith(self.cmd_mark):
+            return line + self.terminator
+        if line.startswith(b'stream '):
+            try:
+                lines, length = (int(value) for value in line.split()[1:3])
+            except ValueError:
+                return b'error: usage stream <lines> <length>' + \
+                    self.terminator
+            return (b'x' * length + self.terminator) * lines
+        return line + self.terminator + self.payload
+
+
+class PtyFirmware:
+    """
+    Firmware answering on a pseudo terminal, `path` is the serial port to
+    connect the service to
+    """
+    def __init__(self, firmware: Firmware = None):
+        self.firmware = firmware or Firmware()
+        self.master, self.slave = os.openpty()
+        # No echo nor translation of line endings, as a real serial device
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        while view and self.running:
+            # Not blocking in read or write, to notice stop
+            _, writable, _ = select.select([], [self.master], [], 0.1)
+            if writable:
+                view = view[os.write(self.master, view):]
+
+    def _run(self):
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                # Slave side closed
+                return
+            answer = self.firmware.feed(data)
+            if answer:
+                self._write(answer)
+
+
+class FirmwareSerial:
+    """
+    In-memory serial port of firmware, used by pyserial's ReaderThread in
+    place of `serial.Serial`. Answers are readable `latency` seconds after
+    the command is written.
+    """
+    def __init__(self, port: str, firmware: Firmware = None, latency=0.0,
+                 **attributes):
+        self.port = port
+        self.firmware = firmware or Firmware()
+        self.latency = latency
+        self.attributes = attributes
+        self.is_open = True
+        # Answers of the firmware, (time readable, data) in order
+        self.answers = collections.deque()
+        self.condition = threading.Condition()
+        self.cancelled = False
+
+    def _due(self) -> int:
+        now = time.monotonic()
+        return sum(len(data) for due, data in self.answers if due <= now)
+
+    @property
+    def in_waiting(self) -> int:
+        with self.condition:
+            return self._due()
+
+    def read(self, size=1) -> bytes:
+        """
+        Wait for answers and return up to `size` bytes of them
+        """
+        with self.condition:
+            while self.is_open and not self.cancelled:
+                if not self.answers:
+                    self.condition.wait()
+                    continue
+                delay = self.answers[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                data = bytearray()
+                while self.answers and len(data) < size and \
+                        self.answers[0][0] <= time.monotonic():
+                    due, answer = self.answers.popleft()
+                    taken = size - len(data)
+                    data += answer[:taken]
+                    if len(answer) > taken:
+                        self.answers.appendleft((due, answer[taken:]))
+                return bytes(data)
+            self.cancelled = False
+            return b''
+
+    def write(self, data: bytes) -> int:
+        answer = self.firmware.feed(bytes(data))
+        if answer:
+            with self.condition:
+                self.answers.append((time.monotonic() + self.latency, answer))
+                self.condition.notify()
+        return len(data)
+
+    def cancel_read(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def get_settings(self):
+        return dict(self.attributes)
+
+    def apply_settings(self, settings):
+        self.attributes.update(settings)
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify()
@@ -6,14 +6,35 @@ Entry point for server
 import os
 
 import eventlet
-from config import config
+from config import Config, config
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
-# Patch eventlet first before importing project's code
-eventlet.monkey_patch()
+# Patch eventlet first before importing project's code, asyncio engine runs
+# on its own event loop instead
+if Config.HUB_ENGINE == 'eventlet':
+    eventlet.monkey_patch()
+
+from .credentials import CredentialCache
+from .metrics import MetricsRegistry
+from .permissions import PermissionIndex
+from .presence import PresenceRegistry
+from .pubsub import PubSub
+from .readcache import ReadCache
+from .sharding import ShardMap
+from .timeseries import SeriesStore
+from .tracing import TraceStore
 
 db = SQLAlchemy()
+credentials = CredentialCache()
+pubsub = PubSub()
+permissions = PermissionIndex()
+series = SeriesStore()
+presence = PresenceRegistry()
+shards = ShardMap()
+reads = ReadCache()
+traces = TraceStore()
+metrics = MetricsRegistry()
 
 
 def create_app(config_name='default'):
@@ -22,6 +43,15 @@ def create_app(config_name='default'):
     config[config_name].init_app(app)
 
     db.init_app(app)
+    pubsub.init_app(app)
+    credentials.init_app(app, pubsub)
+    permissions.init_app(app, pubsub)
+    series.init_app(app)
+    presence.init_app(app)
+    shards.init_app(app)
+    reads.init_app(app)
+    traces.init_app(app)
+    metrics.init_app(app)
     # Redirect http traffic to https on production
     if app.config['SSL_REDIRECT']:
         from flask_sslify import SSLify
@@ -33,8 +63,10 @@ def create_app(config_name='default'):
     # Only possible way to specify message queue is to do here.
     # Ref: https://github.com/miguelgrinberg/Flask-SocketIO/issues/618#issuecomment-722645749
     from .api_0_1 import socketio
-    socketio.init_app(app,
-                      async_mode='eventlet',
-                      message_queue=app.config['MESSAGE_QUEUE'])
+    if app.config['HUB_ENGINE'] == 'eventlet':
+        socketio.init_app(app,
+                          async_mode='eventlet',
+                          message_queue=app.config['MESSAGE_QUEUE'],
+                          serializer=app.config['SOCKETIO_SERIALIZER'])
 
     return app, socketio
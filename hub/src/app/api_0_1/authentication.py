@@ -1,6 +1,7 @@
 from flask import current_app, g, jsonify
 from flask_httpauth import HTTPBasicAuth
 
+from .. import credentials, db
 from ..models import User
 from . import api
 from .errors import forbidden, unauthorized
@@ -14,15 +15,38 @@ def verify_password(email_or_token, password):
     if email_or_token == '':
         return False
     if password == '':
-        g.current_user = User.verify_auth_token(email_or_token)
+        key = credentials.digest(email_or_token)
+        g.current_user = cached_user(key)
         g.token_used = True
+        if g.current_user is None:
+            g.current_user, expiration = User.load_auth_token(email_or_token)
+            if g.current_user is not None:
+                credentials.put(key, g.current_user, expiration)
         return g.current_user is not None
+    key = credentials.digest(email_or_token.lower(), password)
+    user = cached_user(key)
+    if user is not None:
+        g.current_user = user
+        g.token_used = False
+        return True
     user = User.query.filter_by(email=email_or_token.lower()).first()
     if not user:
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    if not user.verify_password(password):
+        return False
+    credentials.put(key, user)
+    return True
+
+
+def cached_user(key: str):
+    """
+    Get user of verified credentials from cache, attached to current database
+    session without querying database
+    """
+    user = credentials.get(key)
+    return db.session.merge(user, load=False) if user is not None else None
 
 
 @auth.error_handler
@@ -3,19 +3,132 @@
 Automata routes
 """
 
+import json
+import queue
+import time
 import uuid
-from typing import Dict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from eventlet import event
+import eventlet
+from eventlet import GreenPool, event
+from eventlet.queue import Queue
 from eventlet.timeout import Timeout
-from flask import current_app, jsonify, request
-from flask_socketio import join_room, leave_room
+from flask import (Response, current_app, g, jsonify, request,
+                   stream_with_context)
+from flask_socketio import emit, join_room, leave_room
 
+from .. import (metrics, permissions, presence, pubsub, reads, series, shards,
+               traces)
+from ..exceptions import ValidationError
+from ..models import Robot, RoboticPermission
 # Import api blueprint from parent (circular dependency)
 from . import api, socketio
+from .decorators import permission_required
 
 # Events for waiting response from robot after sending request
 events = {}
+# Queues for streamed messages from robot after sending request
+streams = {}
+# Channel of replies for requests waiting on other hub nodes
+REPLY_CHANNEL = 'automata:replies'
+# Protocol options of comports robots accept, by framing
+PROTOCOL_OPTIONS = {
+    'text': {
+        'cmd_mark', 'encoding', 'encode_method', 'terminator', 'max_inflight'
+    },
+    'cobs': {
+        'cmd_mark', 'encoding', 'encode_method', 'terminator', 'max_inflight',
+        'negotiate_timeout'
+    },
+}
+# Priority classes of control requests, highest first
+PRIORITIES = ('emergency', 'control', 'bulk')
+
+
+@api.record_once
+def subscribe_replies(state):
+    """
+    Receive replies from robots connected to other hub nodes
+    """
+    pubsub.subscribe(f'{REPLY_CHANNEL}:{state.app.config["HUB_NODE_ID"]}',
+                     lambda message: deliver_reply(message['uuid'],
+                                                   message['reply']))
+
+
+@api.record_once
+def register_gauges(state):
+    """
+    Expose requests waiting for robots and robots connected to this node
+    """
+    metrics.gauge('hub_pending_requests',
+                  'Requests waiting for response of robots',
+                  lambda: len(events) + len(streams))
+    metrics.gauge('hub_connected_robots', 'Robots connected to this node',
+                  lambda: len(presence.robots))
+
+
+@api.record_once
+def subscribe_shards(state):
+    """
+    Relocate robots when hub nodes join or leave
+    """
+    shards.on_change(relocate_robots)
+
+
+def relocate_robots():
+    """
+    Ask robots connected to this node but owned by another node to connect to
+    their owner
+    """
+    for serial_number, robot in list(presence.robots.items()):
+        if not shards.is_owner(serial_number):
+            socketio.emit('relocate', {'url': shards.owner_url(serial_number)},
+                          room=robot['sid'])
+
+
+def deliver_reply(u: str, reply: Dict) -> bool:
+    """
+    Pass reply to the request waiting on this node, if any
+    """
+    if u in events:
+        events[u].send(reply)
+    elif u in streams:
+        streams[u].put(reply)
+    else:
+        return False
+    return True
+
+
+def route_reply(u: str, node: str, reply: Dict):
+    """
+    Pass reply to the request waiting for it, on this node or on the hub node
+    that sent the request
+    """
+    if deliver_reply(u, reply):
+        return
+    if node is not None and node != current_app.config['HUB_NODE_ID']:
+        pubsub.publish(f'{REPLY_CHANNEL}:{node}', {
+            'uuid': u,
+            'reply': reply,
+        })
+
+
+def request_of(response: Dict) -> Dict:
+    """
+    Uuid and node of the request answered by robot response. Robots send
+    them alongside the response, older robots echo the whole request.
+    """
+    return response['request'] if 'request' in response else response
+
+
+def full_response(socket_message: Dict, reply: Dict) -> Dict:
+    """
+    Response of robot with the request it answers, robots only send back the
+    uuid of the request
+    """
+    if 'request' in reply or 'response' not in reply:
+        return reply
+    return {'request': socket_message, 'response': reply['response']}
 
 
 @socketio.on('connect')
@@ -34,7 +147,8 @@ def socket_connect():
 
 @socketio.on('disconnect')
 def socket_disconnect():
-    current_app.logger.info('Robot disconnected: {request.authorization}')
+    presence.disconnect(request.sid)
+    current_app.logger.info(f'Robot disconnected: {request.sid}')
 
 
 @socketio.on('join')
@@ -43,7 +157,15 @@ def socket_room_join(message: Dict):
     After connected, robot will request to join room named its serial number
     """
     # TODO: Allow joining authorized rooms only
+    if not shards.is_owner(message['serial_number']):
+        # Robot belongs to another hub node, ask it to connect there
+        emit('relocate', {'url': shards.owner_url(message['serial_number'])})
+        return
     join_room(message['serial_number'])
+    presence.join(message['serial_number'], request.sid)
+    reads.invalidate(message['serial_number'])
+    if 'comports' in message:
+        presence.set_ports(message['serial_number'], message['comports'])
     current_app.logger.info(
         f'Robot with serial number <{message["serial_number"]}> is ready')
 
@@ -53,8 +175,8 @@ def socket_room_leave(message: Dict):
     """
     When service on robot is shutting down, robot will request to leave room
     """
-    # TODO: Update the database of online robots
     leave_room(message['serial_number'])
+    presence.leave(message['serial_number'], request.sid)
     current_app.logger.info(
         f'Robot with serial number <{message["serial_number"]}> '
         'is shutting down')
@@ -68,63 +190,463 @@ def socket_response(message: Dict):
     """
     current_app.logger.debug(f'Received socket message response'
                              f'\n{message}')
-    try:
-        e = events[message['request']['uuid']]
-        e.send(message)
-    except KeyError:
-        pass
+    request = request_of(message)
+    route_reply(request['uuid'], request.get('node'), message)
+
+
+@socketio.on('telemetry')
+def socket_telemetry(message: Dict):
+    """
+    Handle batches of data sent by robots outside of any request.
+    Returning acknowledges the batch, so robot can send the next one.
+    """
+    presence.touch(message['serial_number'])
+    for comport, batch in message['comports'].items():
+        current_app.logger.debug(
+            f'Received {len(batch["lines"])} telemetry lines from '
+            f'<{message["serial_number"]}> {comport}, '
+            f'{batch["dropped"]} dropped')
+        series.add_lines(message['serial_number'], comport, batch['lines'])
+    return True
 
 
-def socket_send_receive(action: str, message: Dict, room: str, timeout=5):
+@socketio.on('comports_changed')
+def socket_comports_changed(message: Dict):
+    """
+    Handle changes of serial ports available on robot
+    """
+    presence.update_ports(message['serial_number'], message)
+    reads.invalidate(message['serial_number'])
+
+
+@socketio.on('metrics')
+def socket_metrics(message: Dict):
+    """
+    Handle metrics of serial ports sent periodically by robots
+    """
+    metrics.set_robot(message['serial_number'], message['comports'])
+
+
+@socketio.on('stream')
+def socket_stream_line(message: Dict):
+    """
+    Handle lines streamed by robots before the response of a request
+    """
+    route_reply(message['uuid'], message.get('node'),
+                {'line': message['line']})
+
+
+def socket_request(action: str,
+                   message: Dict,
+                   room: str,
+                   timeout=5,
+                   trace: Optional[float] = None) -> Dict:
+    """
+    Send request to robots in the room and wait for the response. If `trace`
+    is the start time of the traced request, the response has its trace.
+    """
+    if not presence.is_online(room):
+        return {'error': f'robot {room} is offline'}
     u = str(uuid.uuid4())
     socket_message = {
         'uuid': u,
+        'node': current_app.config['HUB_NODE_ID'],
         'content': message,
     }
+    if trace is not None:
+        # Uuid is the trace id, robot times the stages of the request
+        socket_message['trace'] = True
+        stages = {'handler': time.monotonic()}
     current_app.logger.debug(f'Sending socket message for action "{action}"'
                              f'\n{socket_message}')
     socketio.emit(action, socket_message, room=room)
+    if trace is not None:
+        stages['emitted'] = time.monotonic()
     timer = Timeout(timeout)
     socket_response = None
+    reply = {}
     try:
         e = events[u] = event.Event()
-        socket_response = e.wait()
+        reply = e.wait()
+        if trace is not None:
+            stages['replied'] = time.monotonic()
+        socket_response = full_response(socket_message, reply)
     except Timeout:
         # abort(504)
         socket_response = {'error': f'request timed out after {timeout}s'}
-        pass
+        metrics.timeout(action)
     finally:
         events.pop(u, None)
         timer.cancel()
+    if trace is not None:
+        socket_response['trace'] = traces.record(u, room, action, trace,
+                                                 stages, reply.get('trace'))
+    return socket_response
+
+
+def socket_stream(action: str, message: Dict, room: str,
+                  timeout=5) -> Iterator[Dict]:
+    """
+    Send request to robots in the room and yield streamed lines as they
+    arrive, ending with the response
+    """
+    if not presence.is_online(room):
+        yield {'error': f'robot {room} is offline'}
+        return
+    u = str(uuid.uuid4())
+    socket_message = {
+        'uuid': u,
+        'node': current_app.config['HUB_NODE_ID'],
+        'content': message,
+    }
+    current_app.logger.debug(f'Sending socket message for action "{action}"'
+                             f'\n{socket_message}')
+    q = streams[u] = Queue()
+    socketio.emit(action, socket_message, room=room)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            item = q.get(timeout=max(deadline - time.monotonic(), 0))
+            if 'line' not in item:
+                yield full_response(socket_message, item)
+                break
+            yield item
+    except queue.Empty:
+        metrics.timeout(action)
+        yield {'error': f'request timed out after {timeout}s'}
+    finally:
+        streams.pop(u, None)
+
+
+def socket_read(action: str,
+                message: Dict,
+                room: str,
+                timeout=5,
+                fresh=False,
+                trace: Optional[float] = None) -> Dict:
+    """
+    Send read-only request to robots in the room and wait for the response.
+    Identical requests in flight share one request to robot, response is
+    taken from cache if any unless `fresh` is set. Only the request sent to
+    robot is traced.
+    """
+    key = reads.key(action, message, room)
+    if not fresh:
+        response = reads.get(key)
+        if response is not None:
+            return response
+    thread = reads.inflight.get(key)
+    if thread is None:
+        app = current_app._get_current_object()
+
+        def read() -> Dict:
+            response = None
+            try:
+                # Not tied to the requester, which may be killed while waiting
+                with app.app_context():
+                    response = socket_request(action,
+                                              message,
+                                              room=room,
+                                              timeout=timeout,
+                                              trace=trace)
+                return response
+            finally:
+                reads.finish(key, room, thread, response)
+
+        thread = eventlet.spawn(read)
+        reads.start(key, room, thread)
+    return thread.wait()
+
+
+def socket_send_receive(action: str, message: Dict, room: str, timeout=5,
+                        read=False, fresh=False):
+    if read:
+        socket_response = socket_read(action,
+                                      message,
+                                      room,
+                                      timeout=timeout,
+                                      fresh=fresh,
+                                      trace=traces.current())
+    else:
+        socket_response = socket_request(action,
+                                         message,
+                                         room,
+                                         timeout=timeout,
+                                         trace=traces.current())
     response = jsonify(socket_response)
     response.status_code = 404 if socket_response.get('error') else 200
     return response
 
 
+def socket_gather(action: str, message: Dict, rooms: List[str], timeout=5,
+                  deadline=10) -> Dict[str, Dict]:
+    """
+    Send request to many rooms concurrently and gather the responses.
+    Rooms without response when the overall deadline hits are reported with
+    an error, responses already gathered are kept.
+    """
+    app = current_app._get_current_object()
+    responses = {}
+
+    def gather(room: str):
+        with app.app_context():
+            try:
+                responses[room] = socket_request(action,
+                                                 message,
+                                                 room=room,
+                                                 timeout=timeout)
+            except Exception as e:
+                app.logger.error(f'Request to {room} failed: {e}')
+                responses[room] = {'error': f'request failed: {e}'}
+
+    pool = GreenPool(
+        max(min(len(rooms), current_app.config['BROADCAST_POOL_SIZE']), 1))
+    threads = []
+    with Timeout(deadline, False):
+        for room in rooms:
+            threads.append(pool.spawn(gather, room))
+        pool.waitall()
+    # Stop waiting for late robots, their events are cleaned up on exit
+    for thread in threads:
+        thread.kill()
+    return {
+        room: responses.get(
+            room, {'error': f'deadline exceeded after {deadline}s'})
+        for room in rooms
+    }
+
+
+def protocol_options(protocol: Optional[Dict]) -> Optional[Dict]:
+    """
+    Check protocol options of comport to connect, robots check the range of
+    `max_inflight`
+    """
+    if protocol is None:
+        return None
+    if not isinstance(protocol, dict):
+        raise ValidationError('protocol must be an object')
+    framing = protocol.get('framing', 'text')
+    if framing not in PROTOCOL_OPTIONS:
+        raise ValidationError('framing must be text or cobs')
+    unknown = set(protocol) - PROTOCOL_OPTIONS[framing] - {'framing'}
+    if unknown:
+        raise ValidationError(
+            f'unknown protocol options {", ".join(sorted(unknown))}')
+    max_inflight = protocol.get('max_inflight', 1)
+    if type(max_inflight) is not int or max_inflight < 1:
+        raise ValidationError('max_inflight must be a positive integer')
+    return protocol
+
+
+def comports_message(method: str, body: Dict) -> Dict:
+    """
+    Message to robot for the HTTP method of comports route
+    """
+    if method == 'POST':
+        return {
+            'cmd': 'connect',
+            'comport': body["comport"],
+            'attributes': body["attributes"],
+            'protocol': protocol_options(body.get("protocol")),
+        }
+    if method == 'PATCH':
+        return {'cmd': 'close', 'comport': body["comport"]}
+    return {'cmd': 'list attached'}
+
+
+def priority_option(body: Dict) -> Optional[str]:
+    """
+    Check priority of control request
+    """
+    priority = body.get('priority')
+    if priority is not None and priority not in PRIORITIES:
+        raise ValidationError(
+            f'priority must be one of {", ".join(PRIORITIES)}')
+    return priority
+
+
+def repl_message(body: Dict, stream=False) -> Dict:
+    """
+    Message to robot for a control request
+    """
+    message = {
+        'comport': body['comport'],
+        'session': body['session'],
+        'cmd': body['cmd'],
+        'timeout': int(body.get('cmd_timeout', 5))
+    }
+    if 'priority' in body:
+        message['priority'] = priority_option(body)
+    if stream:
+        message['stream'] = True
+    return message
+
+
+def check_repl_command(command) -> None:
+    """
+    Check command of robot message sent as is by broadcast, robots need the
+    same keys as in the message of `repl_message`
+    """
+    if not isinstance(command, dict):
+        raise ValidationError('commands must be objects')
+    missing = [
+        key for key in ('comport', 'session', 'cmd') if key not in command
+    ]
+    if missing:
+        raise ValidationError(f'missing keys {", ".join(missing)}')
+    if type(command.get('timeout', 5)) is not int:
+        raise ValidationError('timeout must be an integer')
+    priority_option(command)
+
+
+def repl_batch_message(body: Dict) -> Dict:
+    """
+    Message to robot for a batch of control requests
+    """
+    commands = body.get('commands')
+    if not isinstance(commands, list) or len(commands) == 0:
+        raise ValidationError('commands must be a non-empty list')
+    return {'commands': [repl_message(command) for command in commands]}
+
+
+def broadcast_action(body: Dict) -> Tuple[str, Any, int]:
+    """
+    Action and message of broadcast request, with the permission it requires
+    on each robot
+    """
+    action = body.get('action', 'ping')
+    message = body.get('content') or 'ping'
+    if action == 'ping':
+        return action, message, RoboticPermission.VIEW
+    if action not in ('comports', 'repl', 'repl_batch'):
+        raise ValidationError(f'action {action} cannot be broadcast')
+    if not isinstance(message, dict):
+        raise ValidationError('content must be an object')
+    if action == 'comports':
+        # Listing comports only needs viewing, other commands need managing
+        cmd = message.get('cmd', '')
+        if not isinstance(cmd, str):
+            raise ValidationError('cmd must be a string')
+        if cmd == 'connect':
+            message = dict(message,
+                           protocol=protocol_options(message.get('protocol')))
+        permission = RoboticPermission.VIEW if cmd.startswith(
+            'list') else RoboticPermission.MANAGE
+        return action, message, permission
+    commands = [message] if action == 'repl' else message.get('commands')
+    if not isinstance(commands, list) or len(commands) == 0:
+        raise ValidationError('commands must be a non-empty list')
+    for command in commands:
+        check_repl_command(command)
+    return action, message, RoboticPermission.CONTROL
+
+
+def broadcast_robots(body: Dict, user_id: int,
+                     permission: int) -> Tuple[List[str], Dict[str, Dict]]:
+    """
+    Serial numbers of robots selected by broadcast request that user is
+    allowed to send the request to, and errors of the forbidden ones
+    """
+    serial_numbers = body.get('serial_numbers') or []
+    selector = body.get('selector')
+    if selector:
+        # Wildcards of LIKE are matched literally, like the escape character
+        pattern = selector.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_')
+        pattern = pattern.replace('*', '%').replace('?', '_')
+        serial_numbers += [
+            robot.serial for robot in Robot.query.filter(
+                Robot.serial.like(pattern, escape='\\'))
+        ]
+    if body.get('online'):
+        serial_numbers += [
+            robot['serial_number'] for robot in presence.online()
+        ]
+    if len(serial_numbers) == 0:
+        raise ValidationError('no robot selected')
+    allowed = []
+    forbidden = {}
+    for serial_number in dict.fromkeys(serial_numbers):
+        if permissions.can(user_id, serial_number, permission):
+            allowed.append(serial_number)
+        else:
+            forbidden[serial_number] = {'error': 'forbidden'}
+    return allowed, forbidden
+
+
+def online_robots(user_id: int) -> List[Dict]:
+    """
+    Online robots that user can view
+    """
+    return [
+        robot for robot in presence.online() if permissions.can(
+            user_id, robot['serial_number'], RoboticPermission.VIEW)
+    ]
+
+
+def known_ports(serial_number: str, args) -> Optional[Dict]:
+    """
+    Response of physical ports route from the last known serial ports of
+    robot, None if unknown or refresh is asked by query string
+    """
+    if args.get('refresh'):
+        return None
+    ports = presence.get_ports(serial_number)
+    if ports is None:
+        return None
+    return {'response': {'result': ports}, 'cached': True}
+
+
+def series_query(serial_number: str, args) -> Dict:
+    """
+    Telemetry values of robot for the query string of series route
+    """
+    end = args.get('to', time.time(), type=float)
+    start = args.get('from', end - 3600, type=float)
+    step = args.get('step', 0, type=float)
+    return series.query(serial_number,
+                        start,
+                        end,
+                        step=step,
+                        comport=args.get('comport'),
+                        name=args.get('name'))
+
+
 @api.route('/automata/<serial_number>/ping')
+@permission_required(RoboticPermission.VIEW)
 def ping(serial_number: str):
     """
     Check if robot with specified serial number is online yet.
     """
-    return socket_send_receive('ping', 'ping', room=serial_number)
+    return socket_send_receive('ping', 'ping', room=serial_number, read=True)
 
 
 @api.route('/automata/<serial_number>/physical_ports', methods=['GET'])
+@permission_required(RoboticPermission.VIEW)
 def physical_ports(serial_number: str):
     """
-    List available comports.
+    List available comports, from the last known ports sent by robot unless
+    `refresh` is set in query string.
     """
+    response = known_ports(serial_number, request.args)
+    if response is not None:
+        return jsonify(response)
     message = {'cmd': 'list available'}
     timeout = int(request.json.get('timeout', 5)) if request.get_json(
         silent=True) else 5
     return socket_send_receive('comports',
                                message,
                                room=serial_number,
-                               timeout=timeout)
+                               timeout=timeout,
+                               read=True,
+                               fresh=bool(request.args.get('refresh')))
 
 
 @api.route('/automata/<serial_number>/comports',
            methods=['GET', 'POST', 'PATCH'])
+@permission_required(RoboticPermission.VIEW,
+                     POST=RoboticPermission.MANAGE,
+                     PATCH=RoboticPermission.MANAGE)
 def comports(serial_number: str):
     """
     GET: List attached comports.
@@ -132,40 +654,143 @@ def comports(serial_number: str):
     PATCH: Disconnect comport. This is counter-intuitive but as DELETE is not
            accepting request body, this is the only choice
     """
-    message = {}
+    message = comports_message(request.method, request.json)
     timeout = int(request.json.get('timeout', 5)) if request.get_json(
         silent=True) else 5
     if request.method == 'GET':
-        message = {'cmd': 'list attached'}
-    elif request.method == 'POST':
-        message = {
-            'cmd': 'connect',
-            'comport': request.json["comport"],
-            'attributes': request.json["attributes"]
-        }
-    elif request.method == 'PATCH':
-        message = {'cmd': 'close', 'comport': request.json["comport"]}
-    return socket_send_receive('comports',
-                               message,
-                               room=serial_number,
-                               timeout=timeout)
+        return socket_send_receive('comports',
+                                   message,
+                                   room=serial_number,
+                                   timeout=timeout,
+                                   read=True)
+    response = socket_send_receive('comports',
+                                   message,
+                                   room=serial_number,
+                                   timeout=timeout)
+    # Listings read before the change completed are stale
+    reads.invalidate(serial_number)
+    return response
 
 
 @api.route('/automata/<serial_number>/repl', methods=['POST'])
+@permission_required(RoboticPermission.CONTROL)
 def repl(serial_number: str):
     """
     Send control request to robot of specific serial number.
     Since robots at least will join to the room of their serial number, send
     request to the room is enough.
     """
-    message = {
-        'comport': request.json['comport'],
-        'session': request.json['session'],
-        'cmd': request.json['cmd'],
-        'timeout': int(request.json.get('cmd_timeout', 5))
-    }
-    timeout = int(request.json.get('timeout')) or 5
+    message = repl_message(request.json)
+    timeout = int(request.json.get('timeout') or 5)
     return socket_send_receive('repl',
                                message,
                                room=serial_number,
                                timeout=timeout)
+
+
+@api.route('/automata/<serial_number>/repl/batch', methods=['POST'])
+@permission_required(RoboticPermission.CONTROL)
+def repl_batch(serial_number: str):
+    """
+    Send multiple control requests to robot of specific serial number in one
+    round trip. Commands are executed in order for each comport and in
+    parallel across comports, results are returned in the order of commands.
+    """
+    message = repl_batch_message(request.json)
+    timeout = int(request.json.get('timeout', 5))
+    return socket_send_receive('repl_batch',
+                               message,
+                               room=serial_number,
+                               timeout=timeout)
+
+
+@api.route('/automata/broadcast', methods=['POST'])
+def broadcast():
+    """
+    Send the same request to many robots concurrently and gather responses.
+    Robots are specified by a list of serial numbers, a selector matching
+    the serial numbers of registered robots (`*` and `?` wildcards), or all
+    online robots.
+    """
+    action, message, permission = broadcast_action(request.json)
+    timeout = int(request.json.get('timeout', 5))
+    deadline = int(request.json.get('deadline', timeout))
+    allowed, result = broadcast_robots(request.json, g.current_user.id,
+                                       permission)
+    result.update(
+        socket_gather(action,
+                      message,
+                      rooms=allowed,
+                      timeout=timeout,
+                      deadline=deadline))
+    return jsonify({'result': result})
+
+
+@api.route('/automata/<serial_number>/repl/stream', methods=['POST'])
+@permission_required(RoboticPermission.CONTROL)
+def repl_stream(serial_number: str):
+    """
+    Same as repl route, but each line of the session is sent to the client as
+    soon as robot receives it. Lines are sent as server-sent events if client
+    accepts `text/event-stream`, otherwise as json lines.
+    """
+    message = repl_message(request.json, stream=True)
+    timeout = int(request.json.get('timeout', 5))
+    sse = request.accept_mimetypes.best_match(
+        ['application/x-ndjson', 'text/event-stream']) == 'text/event-stream'
+
+    def generate():
+        for item in socket_stream('repl',
+                                  message,
+                                  room=serial_number,
+                                  timeout=timeout):
+            data = json.dumps(item)
+            yield f'data: {data}\n\n' if sse else f'{data}\n'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream' if sse else 'application/x-ndjson')
+
+
+@api.route('/automata/<serial_number>/series', methods=['GET'])
+@permission_required(RoboticPermission.VIEW)
+def robot_series(serial_number: str):
+    """
+    Query recent telemetry values of robot, answered from memory without
+    sending request to robot.
+    """
+    return jsonify({'result': series_query(serial_number, request.args)})
+
+
+@api.route('/automata/<serial_number>/traces', methods=['GET'])
+@permission_required(RoboticPermission.VIEW)
+def robot_traces(serial_number: str):
+    """
+    Recent traces of requests sent to robot by this hub node, most recent
+    first, at most `limit` of them.
+    """
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify({'result': traces.recent(serial_number, limit)})
+
+
+@api.route('/automata/<serial_number>/traces/<trace_id>', methods=['GET'])
+@permission_required(RoboticPermission.VIEW)
+def robot_trace(serial_number: str, trace_id: str):
+    """
+    Trace of request sent to robot, the trace id is the uuid of the request.
+    """
+    trace = traces.get(serial_number, trace_id)
+    if trace is None:
+        response = jsonify({'error': f'trace {trace_id} not found'})
+        response.status_code = 404
+        return response
+    return jsonify({'result': trace})
+
+
+@api.route('/automata/online', methods=['GET'])
+def online():
+    """
+    List robots currently connected to management hub that current user can
+    view.
+    """
+    return jsonify({'result': online_robots(g.current_user.id)})
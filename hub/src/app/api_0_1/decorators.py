@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Decorators for routes
+"""
+
+from functools import wraps
+
+from flask import g, request
+
+from .. import permissions
+from .errors import forbidden
+
+
+def permission_required(permission: int, **methods: int):
+    """
+    Require current user to have permission on the robot of the route.
+    Permission can be overridden for specific HTTP methods.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            required = methods.get(request.method, permission)
+            if not permissions.can(g.current_user.id,
+                                   kwargs['serial_number'], required):
+                return forbidden('Insufficient permissions')
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Routing of requests to the hub node owning the robot
+"""
+
+import urllib.error
+import urllib.request
+
+from flask import Response, current_app, jsonify, redirect, request
+
+from .. import shards
+from . import api
+
+# Header marking requests forwarded by another hub node
+FORWARDED_HEADER = 'X-Hub-Forwarded-By'
+# Timeout in seconds of each read from the owner node
+FORWARD_TIMEOUT = 60
+
+
+@api.before_request
+def route_to_owner():
+    """
+    Requests for robots owned by another hub node are forwarded or
+    redirected to that node. Requests already forwarded are always served,
+    to avoid loops while nodes disagree on owners.
+    """
+    serial_number = (request.view_args or {}).get('serial_number')
+    if serial_number is None or shards.is_owner(serial_number) or \
+            FORWARDED_HEADER in request.headers:
+        return None
+    url = shards.owner_url(serial_number) + request.path
+    if request.query_string:
+        url += f'?{request.query_string.decode()}'
+    if current_app.config['SHARD_ROUTING'] == 'redirect':
+        return redirect(url, code=307)
+    return forward(url)
+
+
+def forward(url: str) -> Response:
+    """
+    Send current request to url and relay the response as it arrives
+    """
+    headers = {
+        key: value
+        for key, value in request.headers.items()
+        if key.lower() not in ('host', 'content-length')
+    }
+    headers[FORWARDED_HEADER] = current_app.config['HUB_NODE_ID']
+    upstream_request = urllib.request.Request(url,
+                                              data=request.get_data() or None,
+                                              headers=headers,
+                                              method=request.method)
+    try:
+        upstream = urllib.request.urlopen(upstream_request,
+                                          timeout=FORWARD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        return Response(e.read(),
+                        status=e.code,
+                        content_type=e.headers.get('Content-Type'))
+    except urllib.error.URLError as e:
+        response = jsonify({'error': f'hub node unreachable: {e.reason}'})
+        response.status_code = 502
+        return response
+
+    def generate():
+        with upstream:
+            # Relay chunks as soon as they arrive, for streamed responses
+            for chunk in iter(lambda: upstream.read1(65536), b''):
+                yield chunk
+
+    return Response(generate(),
+                    status=upstream.status,
+                    content_type=upstream.headers.get('Content-Type'))
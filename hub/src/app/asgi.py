@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio engine of management hub
+"""
+
+import asyncio
+import json
+import re
+import time
+import uuid
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import socketio
+from asgiref.wsgi import WsgiToAsgi
+from flask import g
+from werkzeug.datastructures import MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header
+
+from . import metrics, permissions, presence, reads, series, traces
+from .api_0_1.automata import (broadcast_action, broadcast_robots,
+                               comports_message, full_response,
+                               known_ports, online_robots, repl_batch_message,
+                               repl_message, request_of, series_query)
+from .api_0_1.authentication import before_request
+from .api_0_1.errors import forbidden
+from .exceptions import ValidationError
+from .models import RoboticPermission
+
+AUTOMATA = '/api/v0/automata'
+
+
+class AsyncRequest:
+    """
+    Request received by the asyncio engine, with the few accessors routes
+    need
+    """
+    def __init__(self, scope: Dict, body: bytes):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {
+            name.decode('latin-1'): value.decode('latin-1')
+            for name, value in scope['headers']
+        }
+        self.args = MultiDict(parse_qsl(scope['query_string'].decode()))
+        self.body = body
+        # Start time of the request if traced
+        self.trace_start = traces.sample(bool(self.headers.get('x-trace')))
+
+    @property
+    def json(self) -> Optional[Dict]:
+        if not self.body:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise ValidationError('request body is not valid json')
+
+    @property
+    def accept_mimetypes(self) -> MIMEAccept:
+        return parse_accept_header(self.headers.get('accept'), MIMEAccept)
+
+
+class AsyncHub:
+    """
+    Socket.IO server and automata routes running on asyncio, so each request
+    waiting for robot is a future instead of a thread.
+    Authentication and database queries still use the Flask app, in threads
+    of the default executor; routes without asyncio version are served by the
+    Flask app as well.
+    Robots connected to this node are the only ones reachable, sharing state
+    between hub nodes needs eventlet engine.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.node = app.config['HUB_NODE_ID']
+        self.pool_size = app.config['BROADCAST_POOL_SIZE']
+        self.logger = app.logger
+        # Futures waiting for response from robot after sending request
+        self.events: Dict[str, asyncio.Future] = {}
+        # Queues for streamed messages from robot after sending request
+        self.streams: Dict[str, asyncio.Queue] = {}
+        self.sio = socketio.AsyncServer(
+            async_mode='asgi', serializer=app.config['SOCKETIO_SERIALIZER'])
+        for event in ('connect', 'disconnect', 'join', 'leave', 'response',
+                      'telemetry', 'comports_changed', 'stream', 'metrics'):
+            self.sio.on(event, getattr(self, f'socket_{event}'))
+        metrics.gauge('hub_pending_requests',
+                      'Requests waiting for response of robots',
+                      lambda: len(self.events) + len(self.streams))
+        self.routes: List[Tuple[re.Pattern, Tuple[str, ...], Callable]] = [
+            (re.compile(f'{AUTOMATA}/(?P<serial_number>[^/]+)/ping'),
+             ('GET', ), self.ping),
+            (re.compile(f'{AUTOMATA}/(?P<serial_number>[^/]+)/physical_ports'),
+             ('GET', ), self.physical_ports),
+            (re.compile(f'{AUTOMATA}/(?P<serial_number>[^/]+)/comports'),
+             ('GET', 'POST', 'PATCH'), self.comports),
+            (re.compile(f'{AUTOMATA}/(?P<serial_number>[^/]+)/repl'),
+             ('POST', ), self.repl),
+            (re.compile(f'{AUTOMATA}/(?P<serial_number>[^/]+)/repl/batch'),
+             ('POST', ), self.repl_batch),
+            (re.compile(f'{AUTOMATA}/(?P<serial_number>[^/]+)/repl/stream'),
+             ('POST', ), self.repl_stream),
+            (re.compile(f'{AUTOMATA}/(?P<serial_number>[^/]+)/series'),
+             ('GET', ), self.robot_series),
+            (re.compile(f'{AUTOMATA}/broadcast'), ('POST', ), self.broadcast),
+            (re.compile(f'{AUTOMATA}/online'), ('GET', ), self.online),
+        ]
+        # Routes of the Flask app each route matches, labelling its metrics
+        self.rules = {
+            pattern: re.sub(r'\(\?P<(\w+)>[^)]*\)', r'<\1>', pattern.pattern)
+            for pattern, _, _ in self.routes
+        }
+        self.fallback = WsgiToAsgi(app)
+        self.asgi = socketio.ASGIApp(self.sio, other_asgi_app=self.http)
+
+    # Socket events
+
+    async def socket_connect(self, sid: str, environ: Dict):
+        # TODO: Only allow registered robots
+        self.logger.info('Authorized robot connected')
+
+    async def socket_disconnect(self, sid: str):
+        presence.disconnect(sid)
+        self.logger.info(f'Robot disconnected: {sid}')
+
+    async def socket_join(self, sid: str, message: Dict):
+        self.sio.enter_room(sid, message['serial_number'])
+        presence.join(message['serial_number'], sid)
+        reads.invalidate(message['serial_number'])
+        if 'comports' in message:
+            presence.set_ports(message['serial_number'], message['comports'])
+        self.logger.info(
+            f'Robot with serial number <{message["serial_number"]}> is ready')
+
+    async def socket_leave(self, sid: str, message: Dict):
+        self.sio.leave_room(sid, message['serial_number'])
+        presence.leave(message['serial_number'], sid)
+        self.logger.info(
+            f'Robot with serial number <{message["serial_number"]}> '
+            'is shutting down')
+
+    async def socket_response(self, sid: str, message: Dict):
+        self.deliver_reply(request_of(message)['uuid'], message)
+
+    async def socket_telemetry(self, sid: str, message: Dict):
+        presence.touch(message['serial_number'])
+        for comport, batch in message['comports'].items():
+            series.add_lines(message['serial_number'], comport,
+                             batch['lines'])
+        return True
+
+    async def socket_comports_changed(self, sid: str, message: Dict):
+        presence.update_ports(message['serial_number'], message)
+        reads.invalidate(message['serial_number'])
+
+    async def socket_stream(self, sid: str, message: Dict):
+        self.deliver_reply(message['uuid'], {'line': message['line']})
+
+    async def socket_metrics(self, sid: str, message: Dict):
+        metrics.set_robot(message['serial_number'], message['comports'])
+
+    def deliver_reply(self, u: str, reply: Dict):
+        future = self.events.get(u)
+        if future is not None:
+            if not future.done():
+                future.set_result(reply)
+        elif u in self.streams:
+            self.streams[u].put_nowait(reply)
+
+    # Requests to robots
+
+    def socket_message(self, message) -> Tuple[str, Dict]:
+        u = str(uuid.uuid4())
+        return u, {'uuid': u, 'node': self.node, 'content': message}
+
+    async def socket_request(self,
+                             action: str,
+                             message,
+                             room: str,
+                             timeout=5,
+                             trace: Optional[float] = None) -> Dict:
+        """
+        Send request to robots in the room and wait for the response. If
+        `trace` is the start time of the traced request, the response has its
+        trace.
+        """
+        if not presence.is_online(room):
+            return {'error': f'robot {room} is offline'}
+        u, socket_message = self.socket_message(message)
+        if trace is not None:
+            socket_message['trace'] = True
+            stages = {'handler': time.monotonic()}
+        future = self.events[u] = asyncio.get_running_loop().create_future()
+        reply = {}
+        try:
+            await self.sio.emit(action, socket_message, room=room)
+            if trace is not None:
+                stages['emitted'] = time.monotonic()
+            reply = await asyncio.wait_for(future, timeout)
+            if trace is not None:
+                stages['replied'] = time.monotonic()
+            socket_response = full_response(socket_message, reply)
+        except asyncio.TimeoutError:
+            socket_response = {'error': f'request timed out after {timeout}s'}
+            metrics.timeout(action)
+        finally:
+            self.events.pop(u, None)
+        if trace is not None:
+            socket_response['trace'] = traces.record(
+                u, room, action, trace, stages, reply.get('trace'))
+        return socket_response
+
+    async def socket_stream_request(self, action: str, message, room: str,
+                                    timeout=5) -> AsyncIterator[Dict]:
+        """
+        Send request to robots in the room and yield streamed lines as they
+        arrive, ending with the response
+        """
+        if not presence.is_online(room):
+            yield {'error': f'robot {room} is offline'}
+            return
+        u, socket_message = self.socket_message(message)
+        q = self.streams[u] = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await self.sio.emit(action, socket_message, room=room)
+            while True:
+                item = await asyncio.wait_for(
+                    q.get(), max(deadline - loop.time(), 0))
+                if 'line' not in item:
+                    yield full_response(socket_message, item)
+                    break
+                yield item
+        except asyncio.TimeoutError:
+            metrics.timeout(action)
+            yield {'error': f'request timed out after {timeout}s'}
+        finally:
+            self.streams.pop(u, None)
+
+    async def socket_gather(self, action: str, message, rooms: List[str],
+                            timeout=5, deadline=10) -> Dict[str, Dict]:
+        """
+        Send request to many rooms concurrently and gather the responses
+        until the overall deadline
+        """
+        slots = asyncio.Semaphore(max(min(len(rooms), self.pool_size), 1))
+
+        async def gather(room: str) -> Dict:
+            async with slots:
+                return await self.socket_request(action,
+                                                 message,
+                                                 room=room,
+                                                 timeout=timeout)
+
+        tasks = {room: asyncio.ensure_future(gather(room)) for room in rooms}
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=deadline)
+        responses = {}
+        for room, task in tasks.items():
+            if task.done():
+                error = task.exception()
+                if error is None:
+                    responses[room] = task.result()
+                else:
+                    self.logger.error(f'Request to {room} failed: {error}')
+                    responses[room] = {'error': f'request failed: {error}'}
+            else:
+                task.cancel()
+                responses[room] = {
+                    'error': f'deadline exceeded after {deadline}s'
+                }
+        return responses
+
+    # Http
+
+    async def http(self, scope: Dict, receive, send):
+        if scope['type'] != 'http':
+            return await self.fallback(scope, receive, send)
+        for pattern, methods, route in self.routes:
+            match = pattern.fullmatch(scope['path'])
+            if match and scope['method'] in methods:
+                break
+        else:
+            return await self.fallback(scope, receive, send)
+        body = b''
+        more_body = True
+        while more_body:
+            chunk = await receive()
+            body += chunk.get('body', b'')
+            more_body = chunk.get('more_body', False)
+        request = AsyncRequest(scope, body)
+        start = time.monotonic()
+        status = 500
+
+        async def send_status(message: Dict):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await route(request, send_status, **match.groupdict())
+        except ValidationError as e:
+            await self.send_json(send_status, {
+                'error': 'bad request',
+                'message': e.args[0]
+            }, 400)
+        finally:
+            if metrics.enabled:
+                metrics.observe(self.rules[pattern], scope['method'], status,
+                                time.monotonic() - start)
+
+    async def run_sync(self, f: Callable, *args):
+        """
+        Call f in a thread of the default executor, inside app context
+        """
+        def call():
+            with self.app.app_context():
+                return f(*args)
+
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    async def authorize(self,
+                        request: AsyncRequest,
+                        send,
+                        serial_number: str = None,
+                        permission: int = None) -> Optional[int]:
+        """
+        Authenticate user of request and check permission on robot, return
+        id of user, or None after sending the error response
+        """
+        def check():
+            with self.app.test_request_context(request.path,
+                                               method=request.method,
+                                               headers=request.headers):
+                error = before_request()
+                if error is None and serial_number is not None and \
+                        not permissions.can(g.current_user.id,
+                                            serial_number, permission):
+                    error = forbidden('Insufficient permissions')
+                if error is not None:
+                    return None, error.status_code, error.get_json()
+                return g.current_user.id, None, None
+
+        user_id, status, error = await asyncio.get_running_loop(
+        ).run_in_executor(None, check)
+        if user_id is None:
+            await self.send_json(send, error, status)
+        return user_id
+
+    @staticmethod
+    async def send_json(send, payload: Dict, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def socket_read(self,
+                          action: str,
+                          message,
+                          room: str,
+                          timeout=5,
+                          fresh=False,
+                          trace: Optional[float] = None) -> Dict:
+        """
+        Send read-only request to robots in the room and wait for the
+        response. Identical requests in flight share one request to robot,
+        response is taken from cache if any unless `fresh` is set. Only the
+        request sent to robot is traced.
+        """
+        key = reads.key(action, message, room)
+        if not fresh:
+            response = reads.get(key)
+            if response is not None:
+                return response
+        task = reads.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self.socket_request(action,
+                                    message,
+                                    room,
+                                    timeout=timeout,
+                                    trace=trace))
+            reads.start(key, room, task)
+
+            def done(task: asyncio.Task):
+                response = None
+                if not task.cancelled() and task.exception() is None:
+                    response = task.result()
+                reads.finish(key, room, task, response)
+
+            task.add_done_callback(done)
+        # Requester may be cancelled while waiting, not the shared request
+        return await asyncio.shield(task)
+
+    async def send_receive(self,
+                           send,
+                           action: str,
+                           message,
+                           room: str,
+                           timeout=5,
+                           read=False,
+                           fresh=False,
+                           trace: Optional[float] = None):
+        if read:
+            socket_response = await self.socket_read(action,
+                                                     message,
+                                                     room=room,
+                                                     timeout=timeout,
+                                                     fresh=fresh,
+                                                     trace=trace)
+        else:
+            socket_response = await self.socket_request(action,
+                                                        message,
+                                                        room=room,
+                                                        timeout=timeout,
+                                                        trace=trace)
+        await self.send_json(send, socket_response,
+                             404 if socket_response.get('error') else 200)
+
+    # Routes, see automata routes of api blueprint
+
+    async def ping(self, request: AsyncRequest, send, serial_number: str):
+        if await self.authorize(request, send, serial_number,
+                                RoboticPermission.VIEW) is None:
+            return
+        await self.send_receive(send,
+                                'ping',
+                                'ping',
+                                room=serial_number,
+                                read=True,
+                                trace=request.trace_start)
+
+    async def physical_ports(self, request: AsyncRequest, send,
+                             serial_number: str):
+        if await self.authorize(request, send, serial_number,
+                                RoboticPermission.VIEW) is None:
+            return
+        response = known_ports(serial_number, request.args)
+        if response is not None:
+            return await self.send_json(send, response)
+        body = request.json or {}
+        await self.send_receive(send,
+                                'comports', {'cmd': 'list available'},
+                                room=serial_number,
+                                timeout=int(body.get('timeout', 5)),
+                                read=True,
+                                fresh=bool(request.args.get('refresh')),
+                                trace=request.trace_start)
+
+    async def comports(self, request: AsyncRequest, send, serial_number: str):
+        permission = RoboticPermission.VIEW if request.method == 'GET' \
+            else RoboticPermission.MANAGE
+        if await self.authorize(request, send, serial_number,
+                                permission) is None:
+            return
+        body = request.json or {}
+        await self.send_receive(send,
+                                'comports',
+                                comports_message(request.method, body),
+                                room=serial_number,
+                                timeout=int(body.get('timeout', 5)),
+                                read=request.method == 'GET',
+                                trace=request.trace_start)
+        if request.method != 'GET':
+            # Listings read before the change completed are stale
+            reads.invalidate(serial_number)
+
+    async def repl(self, request: AsyncRequest, send, serial_number: str):
+        if await self.authorize(request, send, serial_number,
+                                RoboticPermission.CONTROL) is None:
+            return
+        body = request.json
+        await self.send_receive(send,
+                                'repl',
+                                repl_message(body),
+                                room=serial_number,
+                                timeout=int(body.get('timeout') or 5),
+                                trace=request.trace_start)
+
+    async def repl_batch(self, request: AsyncRequest, send,
+                         serial_number: str):
+        if await self.authorize(request, send, serial_number,
+                                RoboticPermission.CONTROL) is None:
+            return
+        body = request.json
+        await self.send_receive(send,
+                                'repl_batch',
+                                repl_batch_message(body),
+                                room=serial_number,
+                                timeout=int(body.get('timeout', 5)),
+                                trace=request.trace_start)
+
+    async def repl_stream(self, request: AsyncRequest, send,
+                          serial_number: str):
+        if await self.authorize(request, send, serial_number,
+                                RoboticPermission.CONTROL) is None:
+            return
+        body = request.json
+        message = repl_message(body, stream=True)
+        sse = request.accept_mimetypes.best_match(
+            ['application/x-ndjson',
+             'text/event-stream']) == 'text/event-stream'
+        mimetype = 'text/event-stream' if sse else 'application/x-ndjson'
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', mimetype.encode())],
+        })
+        async for item in self.socket_stream_request(
+                'repl',
+                message,
+                room=serial_number,
+                timeout=int(body.get('timeout', 5))):
+            data = json.dumps(item)
+            chunk = f'data: {data}\n\n' if sse else f'{data}\n'
+            await send({
+                'type': 'http.response.body',
+                'body': chunk.encode('utf-8'),
+                'more_body': True,
+            })
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def broadcast(self, request: AsyncRequest, send):
+        user_id = await self.authorize(request, send)
+        if user_id is None:
+            return
+        body = request.json
+        action, message, permission = broadcast_action(body)
+        timeout = int(body.get('timeout', 5))
+        deadline = int(body.get('deadline', timeout))
+        allowed, result = await self.run_sync(broadcast_robots, body,
+                                              user_id, permission)
+        result.update(await self.socket_gather(action,
+                                               message,
+                                               rooms=allowed,
+                                               timeout=timeout,
+                                               deadline=deadline))
+        await self.send_json(send, {'result': result})
+
+    async def robot_series(self, request: AsyncRequest, send,
+                           serial_number: str):
+        if await self.authorize(request, send, serial_number,
+                                RoboticPermission.VIEW) is None:
+            return
+        await self.send_json(
+            send, {'result': series_query(serial_number, request.args)})
+
+    async def online(self, request: AsyncRequest, send):
+        user_id = await self.authorize(request, send)
+        if user_id is None:
+            return
+        await self.send_json(
+            send, {'result': await self.run_sync(online_robots, user_id)})
+
+
+def create_asgi_app(app):
+    """
+    ASGI app serving socket events and api routes of Flask app on asyncio
+    """
+    return AsyncHub(app).asgi
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of verified credentials for http basic authentication
+"""
+
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+
+class CredentialCache:
+    """
+    Bounded LRU cache of users whose credentials (email+password or token)
+    were successfully verified, so repeated requests skip password hashing
+    and database query.
+    Entries are keyed by a keyed digest of the credentials, the raw secret is
+    never stored. Entries expire after a TTL or when the token expires, and
+    are invalidated on every hub node when a change of password or email of
+    the user is committed. Operations hold a lock, the asyncio engine
+    authenticates in executor threads.
+    """
+    CHANNEL = 'automata:credentials'
+
+    def __init__(self):
+        self.pubsub = None
+        self.listening = False
+        self.size = 0
+        self.ttl = 0
+        self.secret = b''
+        # Digest -> (user, expiration)
+        self.entries: Dict[str, tuple] = OrderedDict()
+        # User id -> digests of the user
+        self.users: Dict[int, Set[str]] = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app, pubsub):
+        self.size = app.config['AUTH_CACHE_SIZE']
+        self.ttl = app.config['AUTH_CACHE_TTL']
+        self.secret = app.config['SECRET_KEY'].encode('utf-8')
+        self.pubsub = pubsub
+        pubsub.subscribe(self.CHANNEL, self._on_invalidate)
+        self._listen_changes()
+
+    def digest(self, *credentials: str) -> str:
+        message = '\0'.join(credentials).encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user, expiration = entry
+            if expiration <= time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return user
+
+    def put(self, key: str, user, expiration: Optional[float] = None):
+        if self.size <= 0:
+            return
+        expiration = min(expiration or float('inf'), time.time() + self.ttl)
+        with self.lock:
+            self.entries[key] = (user, expiration)
+            self.entries.move_to_end(key)
+            self.users.setdefault(user.id, set()).add(key)
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str):
+        """
+        Remove entry, called with lock held
+        """
+        user, _ = self.entries.pop(key)
+        keys = self.users.get(user.id)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.users[user.id]
+
+    def invalidate(self, user_id: int):
+        """
+        Remove all entries of user
+        """
+        self._invalidate(user_id)
+        self.pubsub.publish(self.CHANNEL, {'user_id': user_id})
+
+    def _invalidate(self, user_id: int):
+        with self.lock:
+            for key in self.users.pop(user_id, ()):
+                self.entries.pop(key, None)
+
+    def _on_invalidate(self, message: Dict):
+        self._invalidate(message['user_id'])
+
+    def _listen_changes(self):
+        from .models import User
+        if self.listening:
+            return
+        self.listening = True
+
+        def track_user(mapper, connection, target):
+            state = inspect(target)
+            if (state.attrs.password_hash.history.has_changes()
+                    or state.attrs.email.history.has_changes()):
+                changes = object_session(target).info.setdefault(
+                    'credential_changes', set())
+                changes.add(target.id)
+
+        event.listen(User, 'after_update', track_user)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def _after_commit(self, session):
+        for user_id in session.info.pop('credential_changes', set()):
+            self.invalidate(user_id)
+
+    def _after_rollback(self, session):
+        session.info.pop('credential_changes', None)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of hub and connected robots, exposed in Prometheus text format
+"""
+
+import bisect
+import collections
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from flask import Response, abort, g, request
+
+# Upper bounds in seconds of the buckets of request latency
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+# Metrics sent by robots for each comport, by key in the metrics of comport
+ROBOT_METRICS = (
+    ('automata_serial_bytes_received_total', 'bytes_received', 'counter',
+     'Bytes received from serial port'),
+    ('automata_serial_lines_received_total', 'lines_received', 'counter',
+     'Lines received from serial port'),
+    ('automata_responses_queue_depth', 'responses', 'gauge',
+     'Lines received outside of sessions, waiting to be read'),
+    ('automata_events_queue_depth', 'events', 'gauge',
+     'Errors of serial port waiting to be read'),
+    ('automata_comport_pending_jobs', 'pending', 'gauge',
+     'Commands waiting for a worker of serial port'),
+)
+
+
+def escape(value: str) -> str:
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"'))
+
+
+def labels(**values: str) -> str:
+    if not values:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"'
+                          for name, value in values.items()) + '}'
+
+
+def histogram_lines(name: str, buckets: Iterable[float], counts: List[int],
+                    total: float, **values: str) -> List[str]:
+    """
+    Samples of a histogram from the count of each bucket (the last one
+    counting values above all bounds), buckets are cumulative in exposition
+    """
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{labels(**values, le=bound)} '
+                     f'{cumulative}')
+    cumulative += counts[-1]
+    lines.append(f'{name}_bucket{labels(**values, le="+Inf")} {cumulative}')
+    lines.append(f'{name}_sum{labels(**values)} {total}')
+    lines.append(f'{name}_count{labels(**values)} {cumulative}')
+    return lines
+
+
+class Histogram:
+    """
+    Number of observed values in each bucket, the last bucket counts values
+    above all bounds
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """
+    Counters of requests served by this hub node, gauges read when scraped,
+    and the last metrics sent by each robot connected to this node with the
+    `metrics` socket event. Served unauthenticated on `/metrics` if
+    `METRICS_ENABLED`, only to `METRICS_ALLOWED_ADDRESSES` if set. Metrics of
+    robots are labelled by serial number only with `METRICS_ROBOT_LABELS`,
+    else they are summed by comport.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.allowed_addresses = set()
+        self.robot_labels = False
+        self.lock = threading.Lock()
+        # Requests and their latency, keyed by route, method then status
+        self.requests: Dict[Tuple[str, str, str], int] = (
+            collections.Counter())
+        self.latency: Dict[str, Histogram] = {}
+        # Requests to robots timed out, by action
+        self.timeouts: Dict[str, int] = collections.Counter()
+        self.gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+        # Last metrics of comports of each robot, keyed by serial number
+        self.robots: Dict[str, Dict] = {}
+
+    def init_app(self, app):
+        self.enabled = app.config['METRICS_ENABLED']
+        self.allowed_addresses = set(app.config['METRICS_ALLOWED_ADDRESSES'])
+        self.robot_labels = app.config['METRICS_ROBOT_LABELS']
+        if not self.enabled:
+            return
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.add_url_rule('/metrics', 'metrics', self._serve)
+
+    def _start_request(self):
+        g.metrics_start = time.monotonic()
+
+    def _end_request(self, response: Response) -> Response:
+        start = g.get('metrics_start')
+        if start is not None:
+            rule = request.url_rule.rule if request.url_rule else 'unmatched'
+            self.observe(rule, request.method, response.status_code,
+                         time.monotonic() - start)
+        return response
+
+    def _serve(self) -> Response:
+        if (self.allowed_addresses
+                and request.remote_addr not in self.allowed_addresses):
+            abort(403)
+        return Response(self.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    def observe(self, route: str, method: str, status: int,
+                duration: float):
+        """
+        Count a request served by hub and its latency in seconds
+        """
+        with self.lock:
+            self.requests[route, method, str(status)] += 1
+            histogram = self.latency.get(route)
+            if histogram is None:
+                histogram = self.latency[route] = Histogram()
+            histogram.observe(duration)
+
+    def timeout(self, action: str):
+        with self.lock:
+            self.timeouts[action] += 1
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]):
+        """
+        Register a gauge read when metrics are scraped, replacing the one
+        with the same name
+        """
+        self.gauges[name] = (help, read)
+
+    def set_robot(self, serial_number: str, comports: Dict[str, Dict]):
+        """
+        Keep metrics sent by robot, ignored if metrics are not served
+        """
+        if not self.enabled:
+            return
+        self.robots[serial_number] = comports
+
+    def render(self) -> str:
+        """
+        Metrics in Prometheus text exposition format
+        """
+        lines = []
+
+        def header(name: str, kind: str, help: str):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            requests = dict(self.requests)
+            latency = {
+                route: (list(histogram.counts), histogram.sum)
+                for route, histogram in self.latency.items()
+            }
+            timeouts = dict(self.timeouts)
+        header('hub_http_requests_total', 'counter',
+               'HTTP requests served by hub')
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append('hub_http_requests_total' +
+                         labels(route=route, method=method, status=status) +
+                         f' {count}')
+        header('hub_http_request_duration_seconds', 'histogram',
+               'Latency of HTTP requests served by hub')
+        for route, (counts, total) in sorted(latency.items()):
+            lines += histogram_lines('hub_http_request_duration_seconds',
+                                     LATENCY_BUCKETS,
+                                     counts,
+                                     total,
+                                     route=route)
+        header('hub_robot_request_timeouts_total', 'counter',
+               'Requests to robots without response in time')
+        for action, count in sorted(timeouts.items()):
+            lines.append(f'hub_robot_request_timeouts_total'
+                         f'{labels(action=action)} {count}')
+        for name, (help, read) in sorted(self.gauges.items()):
+            header(name, 'gauge', help)
+            lines.append(f'{name} {read()}')
+        lines += self._render_robots()
+        return '\n'.join(lines) + '\n'
+
+    def _render_robots(self) -> List[str]:
+        # Registry is imported lazily, it is created after this module
+        from . import presence
+        for serial_number in list(self.robots):
+            if serial_number not in presence.robots:
+                self.robots.pop(serial_number, None)
+        ports = [(serial_number, comport, port)
+                 for serial_number, comports in sorted(self.robots.items())
+                 for comport, port in sorted(comports.items())]
+        if not self.robot_labels:
+            ports = self._sum_ports(ports)
+        lines = []
+
+        def family(name: str, kind: str, help: str, samples: List[str]):
+            if samples:
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                lines.extend(samples)
+
+        def port_labels(robot: Optional[str], comport: str,
+                        **values: str) -> Dict:
+            if robot is not None:
+                values = dict(serial_number=robot, **values)
+            return dict(comport=comport, **values)
+
+        for name, key, kind, help in ROBOT_METRICS:
+            family(name, kind, help, [
+                f'{name}{labels(**port_labels(robot, comport))} {port[key]}'
+                for robot, comport, port in ports if key in port
+            ])
+        name = 'automata_serial_faulty_total'
+        family(name, 'counter', 'Faulty responses or frames of serial port', [
+            f'{name}{labels(**port_labels(robot, comport, kind=kind))} '
+            f'{count}' for robot, comport, port in ports
+            for kind, count in sorted(port.get('faulty', {}).items())
+        ])
+        name = 'automata_send_cmd_duration_seconds'
+        family(name, 'histogram', 'Latency of commands sent to serial port', [
+            line for robot, comport, port in ports if 'send_cmd' in port
+            for line in histogram_lines(name, port['send_cmd']['buckets'],
+                                        port['send_cmd']['counts'],
+                                        port['send_cmd']['sum'],
+                                        **port_labels(robot, comport))
+        ])
+        return lines
+
+    @staticmethod
+    def _sum_ports(ports: List[Tuple[str, str, Dict]]
+                   ) -> List[Tuple[Optional[str], str, Dict]]:
+        """
+        Metrics of ports summed by comport over all robots, histograms with
+        buckets differing from the first one of comport are left out
+        """
+        sums: Dict[str, Dict] = {}
+        for _, comport, port in ports:
+            total = sums.setdefault(comport, {'faulty': {}})
+            for _, key, _, _ in ROBOT_METRICS:
+                if key in port:
+                    total[key] = total.get(key, 0) + port[key]
+            for kind, count in port.get('faulty', {}).items():
+                total['faulty'][kind] = total['faulty'].get(kind, 0) + count
+            histogram = port.get('send_cmd')
+            if histogram is None:
+                continue
+            if 'send_cmd' not in total:
+                total['send_cmd'] = {
+                    'buckets': histogram['buckets'],
+                    'counts': list(histogram['counts']),
+                    'sum': histogram['sum'],
+                }
+            elif total['send_cmd']['buckets'] == histogram['buckets']:
+                summed = total['send_cmd']
+                summed['counts'] = [
+                    total + count for total, count in zip(
+                        summed['counts'], histogram['counts'])
+                ]
+                summed['sum'] += histogram['sum']
+        return [(None, comport, port)
+                for comport, port in sorted(sums.items())]
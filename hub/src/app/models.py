@@ -217,12 +217,19 @@ class User(UserMixin, db.Model):
 
     @staticmethod
     def verify_auth_token(token):
+        return User.load_auth_token(token)[0]
+
+    @staticmethod
+    def load_auth_token(token):
+        """
+        Return user of token and expiration time of token
+        """
         s = Serializer(current_app.config['SECRET_KEY'])
         try:
-            data = s.loads(token)
+            data, header = s.loads(token, return_header=True)
         except:
-            return None
-        return User.query.get(data['id'])
+            return None, None
+        return User.query.get(data['id']), header.get('exp')
 
     def __repr__(self):
         return '<User %r>' % self.username
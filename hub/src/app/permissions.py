@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Index of permissions of users on robots
+"""
+
+from typing import Dict
+
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, object_session
+
+
+class PermissionIndex:
+    """
+    Permission bitmask of each user on each robot, keyed by user id and robot
+    serial number, so checking permission is a dictionary lookup.
+    The whole index is loaded at startup, permissions of a user are reloaded
+    on next lookup after changes of robot users, robots or roles are
+    committed. Invalidations are published to other hub nodes.
+    """
+    CHANNEL = 'automata:permissions'
+
+    def __init__(self):
+        self.pubsub = None
+        self.permissions: Dict[int, Dict[str, int]] = {}
+        self.listening = False
+
+    def init_app(self, app, pubsub):
+        self.pubsub = pubsub
+        pubsub.subscribe(self.CHANNEL, self._on_invalidate)
+        self._listen_changes()
+        with app.app_context():
+            try:
+                self.load_all()
+            except SQLAlchemyError as e:
+                app.logger.warning(f'Cannot load permissions: {e}')
+
+    def _query(self):
+        from . import db
+        from .models import Robot, RoboticRole, RobotUser
+        query = db.session.query(RobotUser.user_id, Robot.serial,
+                                 RoboticRole.permissions)
+        return query.join(Robot, RobotUser.robot_id == Robot.id).join(
+            RoboticRole, RobotUser.role_id == RoboticRole.id)
+
+    def load_all(self):
+        permissions = {}
+        for user_id, serial, mask in self._query():
+            permissions.setdefault(user_id, {})[serial] = mask or 0
+        self.permissions = permissions
+
+    def _load(self, user_id: int) -> Dict[str, int]:
+        from .models import RobotUser
+        return {
+            serial: mask or 0
+            for _, serial, mask in self._query().filter(
+                RobotUser.user_id == user_id)
+        }
+
+    def get(self, user_id: int, serial_number: str) -> int:
+        """
+        Permission bitmask of user on robot
+        """
+        permissions = self.permissions.get(user_id)
+        if permissions is None:
+            permissions = self.permissions[user_id] = self._load(user_id)
+        return permissions.get(serial_number, 0)
+
+    def can(self, user_id: int, serial_number: str, permission: int) -> bool:
+        return self.get(user_id, serial_number) & permission == permission
+
+    def invalidate(self, user_id: int = None):
+        """
+        Forget permissions of user, or of all users if not specified
+        """
+        self._invalidate(user_id)
+        self.pubsub.publish(self.CHANNEL, {'user_id': user_id})
+
+    def _invalidate(self, user_id: int = None):
+        if user_id is None:
+            self.permissions = {}
+        else:
+            self.permissions.pop(user_id, None)
+
+    def _on_invalidate(self, message: Dict):
+        self._invalidate(message['user_id'])
+
+    def _listen_changes(self):
+        from .models import Robot, RoboticRole, RobotUser
+        if self.listening:
+            return
+        self.listening = True
+
+        def track_user(mapper, connection, target):
+            changes = object_session(target).info.setdefault(
+                'permission_changes', set())
+            changes.add(target.user_id)
+
+        def track_all(mapper, connection, target):
+            changes = object_session(target).info.setdefault(
+                'permission_changes', set())
+            changes.add(None)
+
+        event.listen(RobotUser, 'after_insert', track_user)
+        event.listen(RobotUser, 'after_delete', track_user)
+        # User of robot user may change, invalidate all
+        event.listen(RobotUser, 'after_update', track_all)
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(Robot, name, track_all)
+            event.listen(RoboticRole, name, track_all)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def _after_commit(self, session):
+        changes = session.info.pop('permission_changes', set())
+        if None in changes:
+            self.invalidate()
+        else:
+            for user_id in changes:
+                self.invalidate(user_id)
+
+    def _after_rollback(self, session):
+        session.info.pop('permission_changes', None)
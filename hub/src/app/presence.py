@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of robots currently connected to management hub
+"""
+
+import json
+import time
+from typing import Dict, List, Optional
+
+import eventlet
+import redis
+
+from .pubsub import shared_redis_url
+
+
+class PresenceRegistry:
+    """
+    Track which robot is connected to which hub node, from its joining of
+    its room until it leaves or disconnects.
+    Robots connected to this node are kept in memory. If the message queue
+    is redis, presence is also shared with other hub nodes through a redis
+    hash, refreshed periodically so entries of dead nodes expire.
+    """
+    KEY = 'automata:presence'
+    # Delete entry of robot only if it is owned by the node, the robot may
+    # have reconnected to another node already
+    UNPUBLISH = """
+    local entry = redis.call('HGET', KEYS[1], ARGV[1])
+    if entry and cjson.decode(entry)['node'] == ARGV[2] then
+        return redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+
+    def __init__(self):
+        self.node = None
+        self.ttl = 30
+        self.refresh = 10
+        self.redis = None
+        self.unpublish = None
+        self.logger = None
+        # Robots connected to this node, keyed by serial number
+        self.robots: Dict[str, Dict] = {}
+        # Serial number of each socket session
+        self.sids: Dict[str, str] = {}
+        # Last known serial ports available on robots connected to this node,
+        # keyed by serial number then device
+        self.ports: Dict[str, Dict[str, Dict]] = {}
+
+    def init_app(self, app):
+        self.node = app.config['HUB_NODE_ID']
+        self.ttl = app.config['PRESENCE_TTL']
+        self.refresh = app.config['PRESENCE_REFRESH']
+        self.logger = app.logger
+        url = shared_redis_url(app)
+        if url:
+            self.redis = redis.Redis.from_url(url)
+            self.unpublish = self.redis.register_script(self.UNPUBLISH)
+            eventlet.spawn_n(self._heartbeat)
+
+    def _publish(self, robots: List[Dict]):
+        if self.redis is None or len(robots) == 0:
+            return
+        try:
+            self.redis.hset(
+                self.KEY,
+                mapping={
+                    robot['serial_number']: json.dumps(robot)
+                    for robot in robots
+                })
+        except redis.RedisError as e:
+            self.logger.warning(f'Cannot publish presence: {e}')
+
+    def _unpublish(self, serial_number: str):
+        if self.redis is None:
+            return
+        try:
+            self.unpublish(keys=[self.KEY], args=[serial_number, self.node])
+        except redis.RedisError as e:
+            self.logger.warning(f'Cannot publish presence: {e}')
+
+    def _heartbeat(self):
+        while True:
+            eventlet.sleep(self.refresh)
+            now = time.time()
+            for robot in self.robots.values():
+                robot['last_seen'] = now
+            self._publish(list(self.robots.values()))
+
+    def join(self, serial_number: str, sid: str):
+        now = time.time()
+        robot = self.robots[serial_number] = {
+            'serial_number': serial_number,
+            'sid': sid,
+            'node': self.node,
+            'connected_since': now,
+            'last_seen': now,
+        }
+        self.sids[sid] = serial_number
+        self._publish([robot])
+
+    def leave(self, serial_number: str, sid: str):
+        self.sids.pop(sid, None)
+        robot = self.robots.get(serial_number)
+        if robot is not None and robot['sid'] == sid:
+            del self.robots[serial_number]
+            self.ports.pop(serial_number, None)
+            # Store is imported lazily, it is created after this module
+            from . import series
+            series.remove(serial_number)
+            self._unpublish(serial_number)
+
+    def disconnect(self, sid: str):
+        serial_number = self.sids.get(sid)
+        if serial_number is not None:
+            self.leave(serial_number, sid)
+
+    def touch(self, serial_number: str):
+        robot = self.robots.get(serial_number)
+        if robot is not None:
+            robot['last_seen'] = time.time()
+
+    def set_ports(self, serial_number: str, ports: List[Dict]):
+        """
+        Set serial ports sent by robot when joining
+        """
+        self.ports[serial_number] = {port['device']: port for port in ports}
+
+    def update_ports(self, serial_number: str, changes: Dict):
+        """
+        Apply changes of serial ports sent by robot
+        """
+        ports = self.ports.get(serial_number)
+        if ports is None:
+            return
+        for device in changes.get('removed', []):
+            ports.pop(device, None)
+        for port in changes.get('added', []):
+            ports[port['device']] = port
+
+    def get_ports(self, serial_number: str) -> Optional[List[Dict]]:
+        """
+        Last known serial ports of robot connected to this node, None if
+        unknown
+        """
+        ports = self.ports.get(serial_number)
+        return list(ports.values()) if ports is not None else None
+
+    def get(self, serial_number: str) -> Optional[Dict]:
+        """
+        Presence of robot, None if robot is offline
+        """
+        robot = self.robots.get(serial_number)
+        if robot is not None or self.redis is None:
+            return robot
+        try:
+            data = self.redis.hget(self.KEY, serial_number)
+        except redis.RedisError as e:
+            self.logger.warning(f'Cannot read presence: {e}')
+            # Unknown, assume online and let the request time out
+            return {'serial_number': serial_number}
+        if data is None:
+            return None
+        robot = json.loads(data)
+        return robot if robot['last_seen'] > time.time() - self.ttl else None
+
+    def is_online(self, serial_number: str) -> bool:
+        return self.get(serial_number) is not None
+
+    def online(self) -> List[Dict]:
+        """
+        All online robots
+        """
+        if self.redis is None:
+            return list(self.robots.values())
+        try:
+            data = self.redis.hgetall(self.KEY)
+        except redis.RedisError as e:
+            self.logger.warning(f'Cannot read presence: {e}')
+            return list(self.robots.values())
+        deadline = time.time() - self.ttl
+        robots = [json.loads(robot) for robot in data.values()]
+        return [robot for robot in robots if robot['last_seen'] > deadline]
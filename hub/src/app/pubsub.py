@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Publish/subscribe between hub nodes
+"""
+
+import json
+from typing import Callable, Dict, Optional
+
+import eventlet
+import redis
+
+
+def shared_redis_url(app) -> Optional[str]:
+    """
+    Url of the redis shared by hub nodes, None if this node does not share
+    state with other nodes. Sharing needs redis as message queue and eventlet
+    engine to run the background tasks.
+    """
+    url = app.config['MESSAGE_QUEUE']
+    if app.config['HUB_ENGINE'] != 'eventlet' or not url or \
+            not url.startswith('redis'):
+        return None
+    return url
+
+
+class PubSub:
+    """
+    Exchange messages between hub nodes through the redis message queue.
+    Without redis, there is only one node and nothing is exchanged.
+    """
+    def __init__(self):
+        self.redis = None
+        self.pubsub = None
+        self.logger = None
+        self.handlers: Dict[str, Callable[[Dict], None]] = {}
+
+    def init_app(self, app):
+        self.logger = app.logger
+        url = shared_redis_url(app)
+        if url:
+            self.redis = redis.Redis.from_url(url)
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None
+
+    def subscribe(self, channel: str, handler: Callable[[Dict], None]):
+        """
+        Call handler with each message published on channel
+        """
+        self.handlers[channel] = handler
+        if self.redis is None:
+            return
+        if self.pubsub is None:
+            self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(channel)
+            eventlet.spawn_n(self._listen)
+        else:
+            self.pubsub.subscribe(channel)
+
+    def publish(self, channel: str, message: Dict):
+        if self.redis is None:
+            return
+        try:
+            self.redis.publish(channel, json.dumps(message))
+        except redis.RedisError as e:
+            self.logger.warning(f'Cannot publish to {channel}: {e}')
+
+    def _listen(self):
+        while True:
+            try:
+                for message in self.pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    handler = self.handlers.get(message['channel'].decode())
+                    if handler is not None:
+                        handler(json.loads(message['data']))
+            except redis.RedisError as e:
+                self.logger.warning(f'Subscription interrupted: {e}')
+                eventlet.sleep(1)
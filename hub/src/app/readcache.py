@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing and caching of read-only requests to robots
+"""
+
+import json
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+
+class ReadCache:
+    """
+    Bookkeeping of read-only requests to robots (ping, listing comports).
+    Identical requests to the same robot made while one is in flight wait
+    for the one in flight (`inflight` holds the waitable of the engine),
+    successful responses are kept for `READ_CACHE_TTL` seconds (0 to only
+    coalesce). Requests changing the robot invalidate its entries, responses
+    of requests in flight at that time are not cached. Only keys cached or
+    in flight are kept, expired entries are evicted as new ones are cached.
+    """
+    def __init__(self):
+        self.ttl = 0
+        # Key -> (expiration, room, response), oldest first
+        self.entries: Dict[str, Tuple[float, str, Dict]] = {}
+        # Key -> request in flight, waitable by other requesters
+        self.inflight: Dict[str, Any] = {}
+        # Room -> keys of the room cached or in flight
+        self.rooms: Dict[str, Set[str]] = {}
+
+    def init_app(self, app):
+        self.ttl = app.config['READ_CACHE_TTL']
+
+    @staticmethod
+    def key(action: str, message, room: str) -> str:
+        return json.dumps([action, room, message], sort_keys=True)
+
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expiration, room, response = entry
+        if expiration <= time.monotonic():
+            del self.entries[key]
+            self._forget(key, room)
+            return None
+        return response
+
+    def start(self, key: str, room: str, request):
+        """
+        Register request sent to robot, for identical requests to wait for
+        """
+        self.inflight[key] = request
+        self.rooms.setdefault(room, set()).add(key)
+
+    def finish(self, key: str, room: str, request,
+               response: Optional[Dict] = None):
+        """
+        Unregister request sent to robot, and cache its response if the
+        request was not invalidated meanwhile. Response is None if the
+        request failed.
+        """
+        if self.inflight.get(key) is not request:
+            return
+        del self.inflight[key]
+        if response is not None:
+            self._put(key, room, response)
+        self._forget(key, room)
+
+    def _put(self, key: str, room: str, response: Dict):
+        """
+        Cache response without the trace of the request
+        """
+        if self.ttl <= 0 or response.get('error'):
+            return
+        if 'trace' in response:
+            response = {k: v for k, v in response.items() if k != 'trace'}
+        now = time.monotonic()
+        # Entries stay in order of expiration, all have the same TTL
+        self.entries.pop(key, None)
+        self.entries[key] = (now + self.ttl, room, response)
+        self.rooms.setdefault(room, set()).add(key)
+        while True:
+            oldest = next(iter(self.entries))
+            expiration, oldest_room, _ = self.entries[oldest]
+            if expiration > now:
+                break
+            del self.entries[oldest]
+            self._forget(oldest, oldest_room)
+
+    def _forget(self, key: str, room: str):
+        """
+        Drop key from its room if it is neither cached nor in flight
+        """
+        if key in self.entries or key in self.inflight:
+            return
+        keys = self.rooms.get(room)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.rooms[room]
+
+    def invalidate(self, room: str):
+        """
+        Forget cached responses of room, requests in flight are not joined
+        anymore and their responses are not cached
+        """
+        for key in self.rooms.pop(room, ()):
+            self.entries.pop(key, None)
+            self.inflight.pop(key, None)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Assignment of robots to hub nodes by consistent hashing
+"""
+
+import bisect
+import hashlib
+import json
+import time
+from typing import Callable, Dict, List, Optional
+
+import eventlet
+import redis
+
+from .pubsub import shared_redis_url
+
+
+class HashRing:
+    """
+    Consistent hash ring of nodes, each node is placed at `replicas` points
+    on the ring so keys spread evenly and only keys of a joining or leaving
+    node change owner.
+    """
+    def __init__(self, nodes: List[str], replicas=64):
+        self.nodes = sorted(nodes)
+        points = sorted((self._hash(f'{node}#{i}'), node)
+                        for node in self.nodes for i in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8],
+                              'big')
+
+    def owner(self, key: str) -> Optional[str]:
+        if len(self.hashes) == 0:
+            return None
+        index = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.owners[index]
+
+
+class ShardMap:
+    """
+    Map each robot serial number to the hub node owning it.
+    Nodes announce their public url in a redis hash and refresh it
+    periodically, the ring is rebuilt when nodes join or leave and the
+    registered callbacks are called to rebalance robots.
+    Without sharding enabled, this node owns every robot.
+    """
+    KEY = 'automata:nodes'
+
+    def __init__(self):
+        self.enabled = False
+        self.node = None
+        self.url = None
+        self.ttl = 30
+        self.refresh = 10
+        self.redis = None
+        self.logger = None
+        self.urls: Dict[str, str] = {}
+        self.ring = HashRing([])
+        self.callbacks: List[Callable[[], None]] = []
+
+    def init_app(self, app):
+        self.node = app.config['HUB_NODE_ID']
+        self.url = app.config['HUB_PUBLIC_URL']
+        self.ttl = app.config['PRESENCE_TTL']
+        self.refresh = app.config['PRESENCE_REFRESH']
+        self.logger = app.logger
+        self.urls = {self.node: self.url}
+        self.ring = HashRing([self.node])
+        url = shared_redis_url(app)
+        # Sharding needs redis to know the other nodes
+        self.enabled = app.config['SHARDING'] and bool(url)
+        if self.enabled:
+            self.redis = redis.Redis.from_url(url)
+            self._update()
+            eventlet.spawn_n(self._heartbeat)
+
+    def on_change(self, callback: Callable[[], None]):
+        """
+        Call callback when owners of robots change
+        """
+        self.callbacks.append(callback)
+
+    def _update(self):
+        try:
+            self.redis.hset(self.KEY, self.node,
+                            json.dumps({
+                                'url': self.url,
+                                'last_seen': time.time(),
+                            }))
+            nodes = self.redis.hgetall(self.KEY)
+        except redis.RedisError as e:
+            self.logger.warning(f'Cannot update hub nodes: {e}')
+            return
+        deadline = time.time() - self.ttl
+        urls = {}
+        for node, data in nodes.items():
+            data = json.loads(data)
+            if data['last_seen'] > deadline:
+                urls[node.decode()] = data['url']
+        if urls == self.urls:
+            return
+        self.logger.info(f'Hub nodes changed: {sorted(urls)}')
+        self.urls = urls
+        self.ring = HashRing(list(urls))
+        for callback in self.callbacks:
+            callback()
+
+    def _heartbeat(self):
+        while True:
+            eventlet.sleep(self.refresh)
+            self._update()
+
+    def owner(self, serial_number: str) -> str:
+        return self.ring.owner(serial_number) or self.node
+
+    def owner_url(self, serial_number: str) -> str:
+        return self.urls.get(self.owner(serial_number), self.url)
+
+    def is_owner(self, serial_number: str) -> bool:
+        return not self.enabled or self.owner(serial_number) == self.node
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory time series of data sent by robots
+"""
+
+import re
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Separator of values in a telemetry line, e.g. "temp=21.5, humidity:40"
+VALUE_SEPARATOR = re.compile(r'[\s,;]+')
+
+
+class RingBuffer:
+    """
+    Bounded buffer of (timestamp, value) samples backed by arrays, growing
+    up to capacity. When full, the oldest sample is overwritten.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d')
+        self.values = array('d')
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp: float, value: float):
+        if self.size < self.capacity:
+            # Not wrapped yet, start stays at 0
+            self.times.append(timestamp)
+            self.values.append(value)
+            self.size += 1
+            return
+        self.times[self.start] = timestamp
+        self.values[self.start] = value
+        self.start = (self.start + 1) % self.capacity
+
+    def oldest(self) -> Optional[float]:
+        return self.times[self.start] if self.size > 0 else None
+
+    def _bisect(self, timestamp: float) -> int:
+        """
+        Logical index of the first sample not older than timestamp
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[(self.start + middle) % self.capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, start: float, end: float) -> List[Tuple[float, float]]:
+        """
+        Samples with timestamp in [start, end], oldest first
+        """
+        samples = []
+        for i in range(self._bisect(start), self.size):
+            index = (self.start + i) % self.capacity
+            if self.times[index] > end:
+                break
+            samples.append((self.times[index], self.values[index]))
+        return samples
+
+
+class TieredSeries:
+    """
+    Time series keeping recent samples at full resolution and older samples
+    downsampled into coarser tiers. Each tier is a ring buffer of the same
+    capacity holding the mean of samples of each bucket of its resolution.
+    """
+    def __init__(self, capacity: int, resolutions: Iterable[float]):
+        self.raw = RingBuffer(capacity)
+        # Each tier: [resolution, ring buffer, bucket, sum, count]
+        self.tiers = [[resolution, RingBuffer(capacity), None, 0.0, 0]
+                      for resolution in sorted(resolutions)]
+
+    def append(self, timestamp: float, value: float):
+        self.raw.append(timestamp, value)
+        for tier in self.tiers:
+            resolution, ring, bucket, total, count = tier
+            current = timestamp - timestamp % resolution
+            if bucket is not None and current != bucket:
+                # Bucket is complete, store its mean
+                ring.append(bucket, total / count)
+                total, count = 0.0, 0
+            tier[2:] = [current, total + value, count + 1]
+
+    def query(self, start: float, end: float,
+              step: float = 0) -> List[Tuple[float, float]]:
+        """
+        Samples in [start, end]. If step is given, samples are averaged into
+        buckets of step seconds, using the finest tier covering start with
+        resolution not coarser than step.
+        """
+        ring = self.raw
+        for resolution, tier_ring, *_ in self.tiers:
+            oldest = ring.oldest()
+            if resolution > step or len(tier_ring) == 0 or (
+                    oldest is not None and oldest <= start):
+                break
+            ring = tier_ring
+        samples = ring.query(start, end)
+        if step <= 0:
+            return samples
+        buckets: Dict[float, List[float]] = {}
+        for timestamp, value in samples:
+            bucket = buckets.setdefault(timestamp - timestamp % step,
+                                        [0.0, 0])
+            bucket[0] += value
+            bucket[1] += 1
+        return [(bucket, total / count)
+                for bucket, (total, count) in buckets.items()]
+
+
+class SeriesStore:
+    """
+    Time series of each robot connected to this node, keyed by serial
+    number, comport and name of the value. Values of new names are dropped
+    once a robot has `max_series` series. Series of a robot are removed when
+    it goes offline.
+    """
+    def __init__(self):
+        self.capacity = 3600
+        self.resolutions = (10, 60, 600)
+        self.max_series = 100
+        self.series: Dict[str, Dict[Tuple[str, str], TieredSeries]] = {}
+
+    def init_app(self, app):
+        self.capacity = app.config['SERIES_CAPACITY']
+        self.resolutions = app.config['SERIES_RESOLUTIONS']
+        self.max_series = app.config['SERIES_PER_ROBOT']
+
+    @staticmethod
+    def parse_line(line: str) -> Dict[str, float]:
+        """
+        Parse values from line of form "name=value name:value" or a single
+        number, which is named "value". Non-numeric values are ignored.
+        """
+        values = {}
+        for token in VALUE_SEPARATOR.split(line.strip()):
+            separator = '=' if '=' in token else ':'
+            name, _, value = token.rpartition(separator)
+            try:
+                values[name or 'value'] = float(value)
+            except ValueError:
+                pass
+        return values
+
+    def add_lines(self, serial_number: str, comport: str,
+                  lines: List[Tuple[float, str]]):
+        robot = self.series.setdefault(serial_number, {})
+        for timestamp, line in lines:
+            for name, value in self.parse_line(line).items():
+                series = robot.get((comport, name))
+                if series is None:
+                    if len(robot) >= self.max_series:
+                        continue
+                    series = robot[(comport, name)] = TieredSeries(
+                        self.capacity, self.resolutions)
+                series.append(timestamp, value)
+
+    def remove(self, serial_number: str):
+        """
+        Forget series of robot
+        """
+        self.series.pop(serial_number, None)
+
+    def query(self,
+              serial_number: str,
+              start: float,
+              end: float,
+              step: float = 0,
+              comport: str = None,
+              name: str = None) -> List[Dict]:
+        return [{
+            'comport': key[0],
+            'name': key[1],
+            'samples': series.query(start, end, step),
+        } for key, series in self.series.get(serial_number, {}).items()
+                if comport in (None, key[0]) and name in (None, key[1])]
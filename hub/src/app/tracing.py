@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing of requests to robots, from REST call to serial line and back
+"""
+
+import collections
+import random
+import time
+from typing import Deque, Dict, List, Optional
+
+from flask import g, has_request_context, request
+
+# Stages timed by robot, in order, each ending the span named after it
+ROBOT_SPANS = (
+    ('queued', 'dispatch'),  # Handler of the socket event
+    ('started', 'queue'),  # Waiting for a worker of the comport
+    ('slot', 'slot'),  # Waiting for a free session slot of the comport
+    ('locked', 'lock'),  # Waiting for the lock of the serial protocol
+    ('written', 'write'),  # Writing the command to serial
+    ('ended', 'device'),  # Waiting for the end mark of the session
+    ('responded', 'respond'),  # Until the response is sent to hub
+)
+
+
+class TraceStore:
+    """
+    Recent traces of requests sent to robots, kept in memory for each robot.
+    A request is traced with probability `TRACE_SAMPLE_RATE`, or if it has
+    the `X-Trace` header. The trace id is the uuid of the socket message,
+    robots time each stage of traced requests with their monotonic clock and
+    return the timings with the response. Untraced requests only check
+    whether they are traced.
+    """
+    def __init__(self):
+        self.rate = 0.0
+        self.capacity = 100
+        self.traces: Dict[str, Deque[Dict]] = {}
+        self.ids: Dict[str, Dict] = {}
+
+    def init_app(self, app):
+        self.rate = app.config['TRACE_SAMPLE_RATE']
+        self.capacity = app.config['TRACE_CAPACITY']
+        app.before_request(self._sample_request)
+
+    def sample(self, forced=False) -> Optional[float]:
+        """
+        Start time of the request if it is traced, else None
+        """
+        if forced or (self.rate > 0 and random.random() < self.rate):
+            return time.monotonic()
+        return None
+
+    def _sample_request(self):
+        g.trace_start = self.sample(bool(request.headers.get('X-Trace')))
+
+    def current(self) -> Optional[float]:
+        """
+        Start time of the current request if it is traced
+        """
+        return g.get('trace_start') if has_request_context() else None
+
+    def record(self,
+               trace_id: str,
+               room: str,
+               action: str,
+               start: float,
+               stages: Dict[str, float],
+               robot: Optional[Dict[str, float]] = None) -> Dict:
+        """
+        Store the trace of a request made of hub stages (monotonic times of
+        `handler`, `emitted` and `replied`) and robot stages (milliseconds
+        since robot received the request), return it.
+        Spans are in milliseconds since the request was received by hub, the
+        time between emitting and the reply less the time spent on robot is
+        split evenly between both ways.
+        """
+        spans = []
+
+        def span(name: str, begin: float, end: float):
+            spans.append({
+                'name': name,
+                'start_ms': round(begin, 3),
+                'duration_ms': round(end - begin, 3),
+            })
+
+        handler = (stages['handler'] - start) * 1000
+        emitted = (stages['emitted'] - start) * 1000
+        end = (stages.get('replied', time.monotonic()) - start) * 1000
+        span('auth', 0, handler)
+        span('emit', handler, emitted)
+        if robot and 'responded' in robot and 'replied' in stages:
+            hop = max(end - emitted - robot['responded'], 0) / 2
+            received = emitted + hop
+            span('socket', emitted, received)
+            previous = 0.0
+            for stage, name in ROBOT_SPANS:
+                if stage in robot:
+                    span(name, received + previous, received + robot[stage])
+                    previous = robot[stage]
+            span('socket', end - hop, end)
+        else:
+            # Robot not timing stages, or no reply
+            span('robot', emitted, end)
+        trace = {
+            'trace_id': trace_id,
+            'serial_number': room,
+            'action': action,
+            'time': time.time(),
+            'duration_ms': round(end, 3),
+            'spans': spans,
+        }
+        traces = self.traces.setdefault(room, collections.deque())
+        if len(traces) >= self.capacity:
+            self.ids.pop(traces.popleft()['trace_id'], None)
+        traces.append(trace)
+        self.ids[trace_id] = trace
+        return trace
+
+    def recent(self, room: str, limit=100) -> List[Dict]:
+        """
+        Traces of robot, most recent first
+        """
+        traces = self.traces.get(room, ())
+        return [trace for trace, _ in zip(reversed(traces), range(limit))]
+
+    def get(self, room: str, trace_id: str) -> Optional[Dict]:
+        trace = self.ids.get(trace_id)
+        if trace is None or trace['serial_number'] != room:
+            return None
+        return trace
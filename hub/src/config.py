@@ -4,6 +4,7 @@ Config file for server
 """
 
 import os
+import socket
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -15,7 +16,60 @@ class Config:
     ADMIN_PWD = os.getenv('ADMIN_PWD')  # Must be set in environment
     SSL_REDIRECT = False  # Default is not using SSL
     MESSAGE_QUEUE = os.getenv('MESSAGE_QUEUE') or 'redis://localhost:6379/0'
+    # Server engine, 'eventlet' (Flask-SocketIO) or 'asyncio' (ASGI app of
+    # python-socketio AsyncServer, served by uvicorn)
+    HUB_ENGINE = os.getenv('HUB_ENGINE') or 'eventlet'
+    # Serializer of socket.io packets, 'default' (json) or 'msgpack', robots
+    # must use the same
+    SOCKETIO_SERIALIZER = os.getenv('SOCKETIO_SERIALIZER') or 'default'
+    # Unique name of this hub node among nodes sharing the message queue
+    HUB_NODE_ID = os.getenv(
+        'HUB_NODE_ID') or f'{socket.gethostname()}:{os.getpid()}'
+    # Url other hub nodes and robots use to reach this node directly
+    HUB_PUBLIC_URL = os.getenv(
+        'HUB_PUBLIC_URL') or f'http://{HUB_ADDR}:{HUB_PORT}'
+    # Assign robots to hub nodes by consistent hashing of serial numbers,
+    # requests for robots of other nodes are 'forward'-ed or 'redirect'-ed
+    SHARDING = os.getenv('SHARDING', '').lower() in ('1', 'true', 'yes')
+    SHARD_ROUTING = os.getenv('SHARD_ROUTING') or 'forward'
+    # Seconds after which presence of robot shared by other nodes expires,
+    # and interval of refreshing presence of robots connected to this node
+    PRESENCE_TTL = int(os.getenv('PRESENCE_TTL') or '30')
+    PRESENCE_REFRESH = int(os.getenv('PRESENCE_REFRESH') or '10')
+    # Number of verified credentials cached (0 to disable) and their TTL
+    AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE') or '1024')
+    AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL') or '60')
+    # Seconds read-only responses of robots (ping, listing comports) are
+    # cached, 0 to only merge identical requests in flight
+    READ_CACHE_TTL = float(os.getenv('READ_CACHE_TTL') or '0')
+    # Probability of tracing requests to robots (requests with X-Trace header
+    # are always traced), and number of traces kept for each robot
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE') or '0')
+    TRACE_CAPACITY = int(os.getenv('TRACE_CAPACITY') or '100')
+    # Serve metrics of hub and connected robots on /metrics, for Prometheus,
+    # without authentication
+    METRICS_ENABLED = (os.getenv('METRICS_ENABLED')
+                       or '0').lower() in ('1', 'true', 'yes')
+    # Comma-separated addresses allowed to scrape metrics, any if empty
+    METRICS_ALLOWED_ADDRESSES = [
+        address.strip() for address in (
+            os.getenv('METRICS_ALLOWED_ADDRESSES') or '').split(',')
+        if address.strip()
+    ]
+    # Label metrics of robots by serial number, else sum them by comport
+    METRICS_ROBOT_LABELS = (os.getenv('METRICS_ROBOT_LABELS')
+                            or '0').lower() in ('1', 'true', 'yes')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Maximum number of robots waited concurrently by a broadcast request
+    BROADCAST_POOL_SIZE = int(os.getenv('BROADCAST_POOL_SIZE') or '1000')
+    # Samples kept by each tier of robot time series, and resolutions in
+    # seconds of the downsampled tiers
+    SERIES_CAPACITY = int(os.getenv('SERIES_CAPACITY') or '3600')
+    SERIES_RESOLUTIONS = tuple(
+        float(resolution) for resolution in (
+            os.getenv('SERIES_RESOLUTIONS') or '10,60,600').split(','))
+    # Maximum number of series of a robot, values of other names are dropped
+    SERIES_PER_ROBOT = int(os.getenv('SERIES_PER_ROBOT') or '100')
 
     @staticmethod
     def init_app(app):
@@ -36,6 +90,8 @@ class TestConfig(Config):
     ADMIN_USER = os.getenv('ADMIN_USER') or 'admin'
     ADMIN_PWD = os.getenv('ADMIN_PWD') or 'admin'
     SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URL') or 'sqlite://'
+    # Run without redis unless specified
+    MESSAGE_QUEUE = os.getenv('TEST_MESSAGE_QUEUE')
 
 
 class Productionconfig(Config):
@@ -18,6 +18,10 @@ from flask_migrate import Migrate
 
 app, socketio = create_app(os.getenv('FLASK_CONFIG') or 'default')
 migrate = Migrate(app, db)
+if app.config['HUB_ENGINE'] == 'asyncio':
+    from app.asgi import create_asgi_app
+    # Serve with any ASGI server, e.g. `uvicorn hub:asgi`
+    asgi = create_asgi_app(app)
 
 
 @app.shell_context_processor
@@ -38,4 +42,12 @@ def deploy():
 
 
 if __name__ == '__main__':
-    socketio.run(app, host=os.getenv('HUB_ADDR'), port=os.getenv('HUB_PORT'))
+    if app.config['HUB_ENGINE'] == 'asyncio':
+        import uvicorn
+        uvicorn.run(asgi,
+                    host=app.config['HUB_ADDR'],
+                    port=app.config['HUB_PORT'])
+    else:
+        socketio.run(app,
+                     host=os.getenv('HUB_ADDR'),
+                     port=os.getenv('HUB_PORT'))